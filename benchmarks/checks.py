@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+# Behaviour checks of vmware2dhcp against in-process vCenter and dhcpd stand-ins. Exits non-zero when one of them fails
+
+import argparse
+import json
+import logging
+import os
+import pypureomapi
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pytz import timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vmware2dhcp.vmware2dhcp as core
+from fakevsphere import FakeVSphere
+from omapistub import OmapiStub
+from pyVmomi import vim # See https://github.com/vmware/pyvmomi pylint: disable=no-name-in-module
+from run import BenchVmware2dhcp, KEY_NAME, KEY_VALUE
+
+logger = logging.getLogger('checks')
+
+
+class CheckFailure(Exception):
+  pass
+
+
+class FlakyVmware2dhcp(BenchVmware2dhcp):
+  # The first property retrievals fail, the way they do while vCenter is unreachable
+  def __init__(self, cfg, vsphere, failures):
+    BenchVmware2dhcp.__init__(self, cfg, vsphere)
+    self.failures = failures
+    self.committedEarly = False
+
+  def prefetchVms(self, si, events):
+    if self.failures > 0:
+      self.failures -= 1
+      raise ConnectionError('vCenter unreachable')
+    return BenchVmware2dhcp.prefetchVms(self, si, events)
+
+  def commitEvents(self, events):
+    if self.failures > 0:
+      self.committedEarly = True
+    BenchVmware2dhcp.commitEvents(self, events)
+
+
+class CrashingVmware2dhcp(BenchVmware2dhcp):
+  # The event loop fails once it is up, the way it does when vCenter goes away
+  crashes = 0
+
+  def readEvents(self, stream):
+    CrashingVmware2dhcp.crashes += 1
+    raise ConnectionError('vCenter went away')
+
+
+class StopSupervisor(BaseException):
+  pass
+
+
+class ExitHandlers():
+  # Records what gets registered with atexit: the interpreter doesn't tell
+  def __init__(self):
+    self.handlers = []
+
+  def register(self, fn, *args):
+    self.handlers.append(fn)
+    return fn
+
+  def unregister(self, fn):
+    self.handlers = [handler for handler in self.handlers if handler != fn]
+
+
+def expect(condition, message):
+  if not condition:
+    raise CheckFailure(message)
+
+def waitFor(condition, timeout=10):
+  deadline = time.time() + timeout
+  while not condition() and time.time() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+def buildCfg(stub, **overrides):
+  cfg = {
+    'checkpoint_file': '',
+    'dhcp_address': '127.0.0.1',
+    'dhcp_group': None,
+    'dhcp_key_name': KEY_NAME,
+    'dhcp_key_value': KEY_VALUE,
+    'dhcp_pool_size': 2,
+    'dhcp_port': stub.port,
+    'prom_enabled': False,
+    'prom_port': 0,
+    'reconcile_interval': 0,
+    'reconcile_on_startup': False,
+    'vc_address': 'fake-vcenter',
+    'vc_customattribute_cache_ttl': 300,
+    'vc_customattribute_dhcpoption_namespace': 'dhcp.',
+    'vc_event_mode': 'poll',
+    'vc_password': '',
+    'vc_username': '',
+    'vm_networks': ['PROVISIONING_NETWORK'],
+    'vm_rules': {},
+    'workers': 2,
+  }
+  cfg.update(overrides)
+  return cfg
+
+def checkReconcileRepairsWipedServer():
+  # dhcpd restarted without its leases file: the next reconciliation must register every host again
+  stub = OmapiStub(KEY_NAME, KEY_VALUE)
+  stub.serve()
+  vsphere = FakeVSphere()
+  vms = [vsphere.addVm('check{0}.example.com'.format(idx)) for idx in range(20)]
+  v = BenchVmware2dhcp(buildCfg(stub), vsphere)
+  try:
+    si = v.connect()
+    v.customFields = core.CustomFieldCache(si, v.cfg)
+    v.reconcile(si)
+    expect(len(stub.hosts) == len(vms), '{0} host(s) registered by the first reconciliation, expected {1}'.format(len(stub.hosts), len(vms)))
+    with stub.lock:
+      stub.hosts.clear()
+      stub.handles.clear()
+    v.reconcile(si)
+    expect(len(stub.hosts) == len(vms), '{0} host(s) registered after wiping the DHCP server, expected {1}'.format(len(stub.hosts), len(vms)))
+  finally:
+    for dhcpTarget in v.dhcpTargets:
+      dhcpTarget.pool.close()
+    v.workers.close()
+    stub.shutdown()
+
+def checkPrefetchFailureRetriesPage():
+  # Events whose VMs could not be read are neither dropped nor checkpointed: the page is processed again
+  stub = OmapiStub(KEY_NAME, KEY_VALUE)
+  stub.serve()
+  vsphere = FakeVSphere()
+  v = FlakyVmware2dhcp(buildCfg(stub, vc_poll_min_interval=0.01, vc_poll_max_interval=0.05), vsphere, 2)
+  thread = threading.Thread(target=v.start, name='vmware2dhcp', daemon=True)
+  thread.start()
+  try:
+    expect(waitFor(lambda: vsphere.stats['CreateCollectorForEvents']), 'the event collector was never created')
+    vms = [vsphere.addVm('check{0}.example.com'.format(idx)) for idx in range(5)]
+    for vm in vms:
+      vsphere.publish(vim.event.VmCreatedEvent, vm)
+    registered = waitFor(lambda: len(stub.hosts) == len(vms))
+    expect(registered, '{0} host(s) registered after retrieval failures, expected {1}'.format(len(stub.hosts), len(vms)))
+    expect(v.failures == 0, 'VM properties were retrieved only {0} time(s)'.format(2 - v.failures))
+    expect(not v.committedEarly, 'events were checkpointed before their VMs could be read')
+  finally:
+    v.stop()
+    thread.join(10)
+    for dhcpTarget in v.dhcpTargets:
+      dhcpTarget.pool.close()
+    v.workers.close()
+    stub.shutdown()
+
+def checkSupervisorRestartsDontLeak():
+  # Every restart of a source's event loop gets a new instance: threads and exit handlers must not pile up
+  stub = OmapiStub(KEY_NAME, KEY_VALUE)
+  stub.serve()
+  vsphere = FakeVSphere()
+  cfg = buildCfg(stub, sources=[{'vc_address': 'fake-vcenter'}], vc_poll_min_interval=0.01)
+  supervisor = core.Supervisor(cfg)
+  sourceCfg, targetCfgs = supervisor.sources[0]
+  footprints = []
+  exitHandlers = ExitHandlers()
+
+  def createVmware2dhcp(cfg, dhcpTargets, workers):
+    footprints.append((threading.active_count(), len(exitHandlers.handlers)))
+    if len(footprints) > 5:
+      raise StopSupervisor()
+    return CrashingVmware2dhcp(cfg, vsphere, dhcpTargets, workers)
+
+  def supervise():
+    try:
+      supervisor.run(sourceCfg, targetCfgs)
+    except StopSupervisor:
+      pass
+
+  core.Vmware2dhcp, Vmware2dhcp = createVmware2dhcp, core.Vmware2dhcp
+  core.atexit, atexit = exitHandlers, core.atexit
+  thread = threading.Thread(target=supervise, name='supervisor', daemon=True)
+  try:
+    thread.start()
+    thread.join(30)
+    expect(CrashingVmware2dhcp.crashes >= 5, 'the event loop only ran {0} time(s)'.format(CrashingVmware2dhcp.crashes))
+    expect(footprints[1] == footprints[-1], 'threads and exit handlers went from {0} to {1} over {2} restarts'.format(footprints[1], footprints[-1], len(footprints) - 2))
+  finally:
+    core.Vmware2dhcp = Vmware2dhcp
+    core.atexit = atexit
+    for pool in supervisor.pools.values():
+      pool.close()
+    stub.shutdown()
+
+def checkShardHandover():
+  # Two replicas sharing a lease directory: each shard has a single owner, and VM index entries follow the shards
+  leaseDir = tempfile.mkdtemp()
+  cfg = {'dhcp_address': '127.0.0.1', 'shard_count': 16, 'shard_lease_dir': leaseDir, 'vc_address': 'fake-vcenter'}
+  replicas = [core.Vmware2dhcp(dict(cfg, shard_member=member), []) for member in ['a', 'b']]
+  a, b = replicas
+  entries = dict(('vm-{0}'.format(idx), ['00:50:56:00:{0:02x}:{1:02x}'.format(idx // 256, idx % 256)]) for idx in range(200))
+
+  def expectSingleOwners(when):
+    for shard in range(cfg['shard_count']):
+      owners = [replica.shards.member for replica in replicas if replica.shards.owns(shard)]
+      expect(len(owners) == 1, 'shard {0} is owned by {1} {2}'.format(shard, owners, when))
+    for replica in replicas:
+      owned = dict((moId, macAddresses) for moId, macAddresses in entries.items() if replica.shards.owns(replica.shards.shardOf(moId)))
+      expect(replica.vmIndex.macAddresses == owned, 'member {0} indexes {1} VM(s) instead of the {2} of its shards {3}'.format(replica.shards.member, len(replica.vmIndex), len(owned), when))
+
+  try:
+    a.vmIndex.merge(entries)
+    a.shards.heartbeat()
+    a.rebalanceShards()
+    b.shards.heartbeat()
+    expect(b.rebalanceShards() == [], 'member b acquired shards still leased by member a')
+    expect(len(a.shards.ownedShards()) == cfg['shard_count'], 'member a owns {0} shard(s) on its own'.format(len(a.shards.ownedShards())))
+
+    # b joined: a hands its share over, then b acquires it
+    a.rebalanceShards()
+    b.rebalanceShards()
+    expect(a.shards.ownedShards() and b.shards.ownedShards(), 'shards were not spread over both members')
+    expectSingleOwners('once member b joined')
+
+    # b leaves: a takes everything back, index entries included
+    b.releaseShards(b.shards.ownedShards())
+    b.shards.leave()
+    a.rebalanceShards()
+    replicas.remove(b)
+    expectSingleOwners('once member b left')
+  finally:
+    shutil.rmtree(leaseDir)
+
+def checkHungDhcpServerTimesOut():
+  # A pooled session whose requests are never answered is dropped after dhcp_timeout, and the write retried on a new one
+  stub = OmapiStub(KEY_NAME, KEY_VALUE)
+  stub.serve()
+  cfg = buildCfg(stub, dhcp_pool_size=1, dhcp_timeout=0.5)
+  dhcpTarget = core.DhcpTarget(cfg, core.OmapiPool(cfg, 1))
+  try:
+    dhcpTarget.registerHosts(['00:50:56:00:00:01'], {'host-name': 'check1'})
+    expect(len(stub.hosts) == 1, 'the first host was not registered')
+    stub.muted = True
+    thread = threading.Thread(target=dhcpTarget.registerHosts, args=(['00:50:56:00:00:02'], {'host-name': 'check2'}), name='register', daemon=True)
+    thread.start()
+    # The request sent while the server hung is lost for good: only a new session gets an answer
+    time.sleep(1)
+    stub.muted = False
+    thread.join(10)
+    expect(not thread.is_alive(), 'registration still blocked on the hung session')
+    expect(len(stub.hosts) == 2, '{0} host(s) registered once the DHCP server answers again, expected 2'.format(len(stub.hosts)))
+  finally:
+    dhcpTarget.pool.close()
+    stub.shutdown()
+
+def checkChangedOptionsRenameHost():
+  # Even when the DHCP server accepts statement updates, a changed host gets a name matching its new statements
+  stub = OmapiStub(KEY_NAME, KEY_VALUE, rejectStatementUpdates=False)
+  stub.serve()
+  cfg = buildCfg(stub, dhcp_pool_size=1)
+  pool = core.OmapiPool(cfg, 1)
+  macAddress = '00:50:56:00:00:01'
+  try:
+    core.DhcpTarget(cfg, pool).registerHosts([macAddress], {'host-name': 'before'})
+    core.DhcpTarget(cfg, pool).registerHosts([macAddress], {'host-name': 'after'})
+    writes = stub.stats['create'] + stub.stats['update'] + stub.stats['delete']
+    # A restarted vmware2dhcp has an empty desired state: it must recognize the host from its name alone
+    core.DhcpTarget(cfg, pool).registerHosts([macAddress], {'host-name': 'after'}, verify=True)
+    rewrites = stub.stats['create'] + stub.stats['update'] + stub.stats['delete'] - writes
+    expect(rewrites == 0, 'unchanged host written {0} more time(s) after its options changed'.format(rewrites))
+  finally:
+    pool.close()
+    stub.shutdown()
+
+def checkStaleCheckpointKeepsNewEvents():
+  # Checkpointed event keys only hide the events they cover: not those of another vCenter, nor later ones numbered from scratch
+  for case in ['another vCenter', 'keys started over']:
+    stub = OmapiStub(KEY_NAME, KEY_VALUE)
+    stub.serve()
+    vsphere = FakeVSphere()
+    checkpointDir = tempfile.mkdtemp()
+    checkpointFile = os.path.join(checkpointDir, 'checkpoint.json')
+    with open(checkpointFile, 'w') as fh:
+      json.dump({
+        'vcenter': 'another-vcenter' if case == 'another vCenter' else vsphere.instanceUuid,
+        'key': 1000,
+        'createdTime': (datetime.now(timezone('UTC')) - timedelta(seconds=10)).isoformat(),
+      }, fh)
+    v = BenchVmware2dhcp(buildCfg(stub, checkpoint_file=checkpointFile, vc_poll_min_interval=0.01, vc_poll_max_interval=0.05), vsphere)
+    thread = threading.Thread(target=v.start, name='vmware2dhcp', daemon=True)
+    thread.start()
+    try:
+      expect(waitFor(lambda: vsphere.stats['CreateCollectorForEvents']), 'the event collector was never created')
+      vms = [vsphere.addVm('check{0}.example.com'.format(idx)) for idx in range(3)]
+      for vm in vms:
+        vsphere.publish(vim.event.VmCreatedEvent, vm)
+      registered = waitFor(lambda: len(stub.hosts) == len(vms), 5)
+      expect(registered, '{0} host(s) registered after a checkpoint of {1}, expected {2}'.format(len(stub.hosts), case, len(vms)))
+    finally:
+      v.stop()
+      thread.join(10)
+      for dhcpTarget in v.dhcpTargets:
+        dhcpTarget.pool.close()
+      v.workers.close()
+      stub.shutdown()
+      shutil.rmtree(checkpointDir)
+
+def checkNonStringAttributeRules():
+  # Attribute rules parsed by YAML as numbers or booleans still match the string values of vCenter
+  stub = OmapiStub(KEY_NAME, KEY_VALUE)
+  stub.serve()
+  vsphere = FakeVSphere()
+  vms = [vsphere.addVm('check{0}.example.com'.format(idx), customValues={102: value}) for idx, value in enumerate(['5', 'true', '6'])]
+  v = BenchVmware2dhcp(buildCfg(stub, vm_rules={'attributes': {'owner': [5, True]}}), vsphere)
+  try:
+    si = v.connect()
+    v.customFields = core.CustomFieldCache(si, v.cfg)
+    v.reconcile(si)
+    expected = set(mac for vm in vms[:2] for mac in vm.macAddresses)
+    registered = set(pypureomapi.unpack_mac(mac) for mac in stub.hosts)
+    expect(registered == expected, '{0} host(s) registered, expected those of the VMs owned by 5 and true only'.format(len(registered)))
+  finally:
+    for dhcpTarget in v.dhcpTargets:
+      dhcpTarget.pool.close()
+    v.workers.close()
+    stub.shutdown()
+
+def checkOutOfOrderReplies():
+  # Pipelined responses are matched to their request by transaction id, not by arrival order
+  stub = OmapiStub(KEY_NAME, KEY_VALUE)
+  stub.serve()
+  cfg = buildCfg(stub, dhcp_pool_size=1)
+  pool = core.OmapiPool(cfg, 1)
+  unchanged, missing, changed = ['00:50:56:00:00:0{0}'.format(idx) for idx in range(1, 4)]
+  options = {'host-name': 'after'}
+  try:
+    core.DhcpTarget(cfg, pool).registerHosts([unchanged], options)
+    core.DhcpTarget(cfg, pool).registerHosts([changed], {'host-name': 'before'})
+    writes = (stub.stats['create'], stub.stats['delete'])
+    stub.reverseReplies = True
+    dhcpTarget = core.DhcpTarget(cfg, pool)
+    dhcpTarget.registerHosts([unchanged, missing, changed], options, verify=True)
+    writes = (stub.stats['create'] - writes[0], stub.stats['delete'] - writes[1])
+    expect(writes == (2, 1), '{0} host(s) created and {1} deleted, expected 2 and 1'.format(*writes))
+    fingerprint = core.DhcpTarget.fingerprint(core.MyOmapi.build_statements(options))
+    for macAddress in [unchanged, missing, changed]:
+      handle = stub.hosts.get(pypureomapi.pack_mac(macAddress))
+      name = stub.handles[handle].get(b'name') if handle is not None else None
+      expect(name == core.DhcpTarget.hostName(macAddress, fingerprint).encode('utf8'), 'host {0} is registered as {1}'.format(macAddress, name))
+      expect(dhcpTarget.store.get(macAddress) == fingerprint, 'desired state of {0} is {1}'.format(macAddress, dhcpTarget.store.get(macAddress)))
+
+    # A response to no pending request means the session is out of step with the server
+    stub.reverseReplies = False
+    stub.duplicateReplies = True
+    dhcpServer = core.MyOmapi('127.0.0.1', stub.port, KEY_NAME, KEY_VALUE, 5)
+    try:
+      dhcpServer.query_pipelined([core.MyOmapi.host_lookup_message(macAddress) for macAddress in [unchanged, missing, changed]])
+      expect(False, 'duplicate responses were accepted')
+    except pypureomapi.OmapiError as e:
+      expect('not the response of any pending request' in str(e), 'unexpected error on duplicate responses: {0}'.format(e))
+    finally:
+      dhcpServer.close()
+  finally:
+    pool.close()
+    stub.shutdown()
+
+CHECKS = [
+  checkReconcileRepairsWipedServer,
+  checkPrefetchFailureRetriesPage,
+  checkSupervisorRestartsDontLeak,
+  checkShardHandover,
+  checkHungDhcpServerTimesOut,
+  checkChangedOptionsRenameHost,
+  checkStaleCheckpointKeepsNewEvents,
+  checkNonStringAttributeRules,
+  checkOutOfOrderReplies,
+]
+
+def main():
+  parser = argparse.ArgumentParser(description='Offline vmware2dhcp behaviour checks')
+  parser.add_argument('checks', nargs='*', help='Checks to run (default: all of them)')
+  parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help='Log level (default: %(default)s)')
+  args = parser.parse_args()
+  logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+  core.SLEEP_TIME = 0.05
+  failures = 0
+  for check in CHECKS:
+    if args.checks and check.__name__ not in args.checks:
+      continue
+    try:
+      check()
+      print('PASS {0}'.format(check.__name__))
+    except Exception as e:
+      failures += 1
+      print('FAIL {0}: {1}'.format(check.__name__, e))
+  return 1 if failures else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+# In-process stand-in for the few vCenter services vmware2dhcp talks to:
+# the event manager, the property collector and the custom fields manager
+
+import collections
+import threading
+import time
+import uuid
+from datetime import datetime
+from pytz import timezone
+from pyVmomi import vim, vmodl # See https://github.com/vmware/pyvmomi pylint: disable=no-name-in-module
+
+
+class FakeVm():
+  def __init__(self, moId, name, guestId, macAddresses, network, customValues, folder='group-v1', resourcePool='resgroup-1'):
+    self.moId = moId
+    self.name = name
+    self.guestId = guestId
+    self.macAddresses = macAddresses
+    self.network = network
+    self.customValues = customValues
+    self.folder = folder
+    self.resourcePool = resourcePool
+    self.ref = vim.VirtualMachine(moId)
+
+
+class FakeProperty():
+  def __init__(self, name, val):
+    self.name = name
+    self.val = val
+
+
+class FakeObjectContent():
+  def __init__(self, obj, propSet):
+    self.obj = obj
+    self.propSet = propSet
+
+
+class FakeRetrieveResult():
+  def __init__(self, objects):
+    self.objects = objects
+    self.token = None
+
+
+class FakeContainerView(vim.view.ContainerView):
+  def Destroy(self):
+    pass
+
+
+class FakeEventCollector():
+  def __init__(self, vsphere, beginTime):
+    self.vsphere = vsphere
+    self.beginTime = beginTime
+    self.position = 0
+
+  def SetCollectorPageSize(self, maxCount):
+    self.vsphere.call('SetCollectorPageSize')
+
+  def ReadNextEvents(self, maxCount):
+    self.vsphere.call('ReadNextEvents')
+    with self.vsphere.lock:
+      events = self.vsphere.events[self.position:self.position + maxCount]
+      self.position += len(events)
+      self.vsphere.readEvents = max(self.vsphere.readEvents, self.position)
+    return [event for event in events if event.createdTime >= self.beginTime]
+
+  def DestroyCollector(self):
+    self.vsphere.call('DestroyCollector')
+
+
+class FakeEventManager():
+  def __init__(self, vsphere):
+    self.vsphere = vsphere
+
+  def CreateCollectorForEvents(self, filter):
+    self.vsphere.call('CreateCollectorForEvents')
+    return FakeEventCollector(self.vsphere, filter.time.beginTime)
+
+
+class FakePropertyCollector():
+  def __init__(self, vsphere):
+    self.vsphere = vsphere
+
+  def RetrievePropertiesEx(self, specSet, options):
+    self.vsphere.call('RetrievePropertiesEx')
+    vms = []
+    properties = set()
+    for propertySpec in specSet[0].propSet:
+      if propertySpec.type == vim.VirtualMachine:
+        properties.update(propertySpec.pathSet)
+    with self.vsphere.lock:
+      for objectSpec in specSet[0].objectSet:
+        if isinstance(objectSpec.obj, vim.view.ContainerView):
+          vms.extend(self.vsphere.vms.values())
+        elif objectSpec.obj._moId in self.vsphere.vms:
+          vms.append(self.vsphere.vms[objectSpec.obj._moId])
+        else:
+          raise vmodl.fault.ManagedObjectNotFound(obj=objectSpec.obj)
+    objects = []
+    parents = set()
+    for vm in vms:
+      objects.append(self.vsphere.vmContent(vm, properties))
+      parents.add((vim.Network, vm.network))
+      if 'parent' in properties:
+        parents.add((vim.Folder, vm.folder))
+      if 'resourcePool' in properties:
+        parents.add((vim.ResourcePool, vm.resourcePool))
+    for parentType, parent in parents:
+      objects.append(FakeObjectContent(parentType(parent), [FakeProperty('name', self.vsphere.names[parent])]))
+    return FakeRetrieveResult(objects)
+
+  def ContinueRetrievePropertiesEx(self, token):
+    raise vmodl.fault.InvalidArgument(invalidProperty='token')
+
+
+class FakeCustomFieldsManager():
+  def __init__(self, vsphere):
+    self.vsphere = vsphere
+
+  @property
+  def field(self):
+    self.vsphere.call('customFieldsManager.field')
+    return self.vsphere.fields
+
+
+class FakeViewManager():
+  def __init__(self, vsphere):
+    self.vsphere = vsphere
+
+  def CreateContainerView(self, container, type, recursive):
+    self.vsphere.call('CreateContainerView')
+    return FakeContainerView('session[bench]view-1')
+
+
+class FakeContent():
+  def __init__(self, vsphere):
+    self.about = vim.AboutInfo(instanceUuid=vsphere.instanceUuid)
+    self.eventManager = FakeEventManager(vsphere)
+    self.propertyCollector = FakePropertyCollector(vsphere)
+    self.customFieldsManager = FakeCustomFieldsManager(vsphere)
+    self.viewManager = FakeViewManager(vsphere)
+    self.rootFolder = vim.Folder('group-d1')
+
+
+class FakeServiceInstance():
+  def __init__(self, vsphere):
+    self.content = FakeContent(vsphere)
+
+
+class FakeVSphere():
+  def __init__(self, latency=0, namespace='dhcp.'):
+    # every call sent to this fake vCenter takes that long (in seconds)
+    self.latency = latency
+    self.lock = threading.Lock()
+    self.vms = {}
+    # names of the networks, folders and resource pools
+    self.names = {'network-1': 'PROVISIONING_NETWORK', 'network-2': 'PRODUCTION_NETWORK', 'group-v1': 'Provisioning', 'resgroup-1': 'Build'}
+    self.fields = [
+      vim.CustomFieldsManager.FieldDef(key=101, name='{0}pxelinux.configfile'.format(namespace), managedObjectType=vim.VirtualMachine),
+      vim.CustomFieldsManager.FieldDef(key=102, name='owner', managedObjectType=vim.VirtualMachine),
+    ]
+    self.instanceUuid = str(uuid.uuid4())
+    self.events = []
+    self.readEvents = 0
+    self.nextVm = 1
+    self.nextMac = 1
+    self.stats = collections.Counter()
+
+  def call(self, name):
+    with self.lock:
+      self.stats[name] += 1
+    if self.latency:
+      time.sleep(self.latency)
+
+  def serviceInstance(self):
+    return FakeServiceInstance(self)
+
+  def addVm(self, name, guestId='centos7_64Guest', nics=1, network='network-1', customValues=None):
+    with self.lock:
+      moId = 'vm-{0}'.format(self.nextVm)
+      self.nextVm += 1
+      macAddresses = []
+      for _ in range(nics):
+        macAddresses.append('00:50:56:{0:02x}:{1:02x}:{2:02x}'.format((self.nextMac >> 16) & 0xff, (self.nextMac >> 8) & 0xff, self.nextMac & 0xff))
+        self.nextMac += 1
+      if customValues is None:
+        customValues = {101: 'pxelinux.cfg/anyguest.cfg', 102: 'bench'}
+      vm = FakeVm(moId, name, guestId, macAddresses, network, customValues)
+      self.vms[moId] = vm
+    return vm
+
+  def vmContent(self, vm, properties):
+    devices = [vim.vm.device.VirtualDisk(key=2000)]
+    for idx, macAddress in enumerate(vm.macAddresses):
+      devices.append(vim.vm.device.VirtualVmxnet3(key=4000 + idx, macAddress=macAddress))
+    propSet = [
+      FakeProperty('config.name', vm.name),
+      FakeProperty('config.guestId', vm.guestId),
+      FakeProperty('config.hardware.device', devices),
+      FakeProperty('customValue', [vim.CustomFieldsManager.StringValue(key=key, value=value) for key, value in vm.customValues.items()]),
+      FakeProperty('network', [vim.Network(vm.network)]),
+      FakeProperty('parent', vim.Folder(vm.folder)),
+      FakeProperty('resourcePool', vim.ResourcePool(vm.resourcePool)),
+    ]
+    return FakeObjectContent(vm.ref, [prop for prop in propSet if prop.name in properties])
+
+  def publish(self, eventType, vm):
+    with self.lock:
+      key = len(self.events) + 1
+      event = eventType(
+        key=key,
+        chainId=key,
+        createdTime=datetime.now(timezone('UTC')),
+        userName='bench',
+        fullFormattedMessage='{0} on {1}'.format(eventType.__name__, vm.name),
+        vm=vim.event.VmEventArgument(vm=vm.ref, name=vm.name),
+      )
+      if eventType is vim.event.VmRenamedEvent:
+        event.oldName = event.newName = vm.name
+      self.events.append(event)
+    return event
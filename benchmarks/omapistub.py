@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+# Minimal in-process OMAPI server standing in for isc-dhcp-server
+
+import collections
+import pypureomapi
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+
+class OmapiStubHandler(socketserver.BaseRequestHandler):
+  def setup(self):
+    self.authenticators = {0: pypureomapi.OmapiNullAuthenticator()}
+    self.authid = 0
+
+  def handle(self):
+    self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.request.sendall(pypureomapi.OmapiStartupMessage().as_string())
+    inbuffer = pypureomapi.InBuffer()
+    parser = inbuffer.parse_startup_message()
+    while True:
+      try:
+        data = self.request.recv(65536)
+      except OSError:
+        return
+      if not data:
+        return
+      inbuffer.feed(data)
+      # every burst of pipelined messages costs the client a single round trip
+      with self.server.lock:
+        self.server.stats['roundtrips'] += 1
+      replies = []
+      while True:
+        result = next(parser)
+        if result is None:
+          break
+        parser = inbuffer.parse_message()
+        inbuffer.resetsize()
+        if isinstance(result, pypureomapi.OmapiMessage):
+          with self.server.lock:
+            self.server.stats['messages'] += 1
+          if self.server.muted:
+            continue
+          # the answer to the authenticator creation is signed with the previous authenticator
+          authenticator = self.authenticators[self.authid]
+          replies.append((result, self.server.dispatch(self, result), authenticator))
+      if self.server.reverseReplies:
+        replies.reverse()
+      for request, response, authenticator in replies:
+        self.reply(request, response, authenticator)
+        if self.server.duplicateReplies:
+          self.reply(request, response, authenticator)
+
+  def reply(self, request, response, authenticator):
+    if self.server.latency:
+      time.sleep(self.server.latency)
+    response.rid = request.tid
+    response.generate_tid()
+    response.sign(authenticator)
+    self.request.sendall(response.as_string())
+
+
+class OmapiStub(socketserver.ThreadingMixIn, socketserver.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, keyName, keyValue, latency=0, address=('127.0.0.1', 0), rejectStatementUpdates=True):
+    socketserver.TCPServer.__init__(self, address, OmapiStubHandler)
+    self.keyName = keyName.encode('utf8')
+    self.keyValue = keyValue.encode('utf8')
+    self.latency = latency
+    # isc-dhcp-server refuses to replace the statements of an existing host
+    self.rejectStatementUpdates = rejectStatementUpdates
+    # A hung DHCP server: requests are read, but never answered
+    self.muted = False
+    # Answer the requests received at once last first, or answer each of them twice
+    self.reverseReplies = False
+    self.duplicateReplies = False
+    self.lock = threading.Lock()
+    self.hosts = {}
+    self.handles = {}
+    self.nextHandle = 1
+    self.commits = []
+    self.stats = collections.Counter()
+
+  @property
+  def port(self):
+    return self.server_address[1]
+
+  def serve(self):
+    thread = threading.Thread(target=self.serve_forever, name='omapi-stub', daemon=True)
+    thread.start()
+    return thread
+
+  def status(self, error=False):
+    return pypureomapi.OmapiMessage(opcode=pypureomapi.OMAPI_OP_STATUS, message=[(b'result', struct.pack('!I', 1 if error else 0))])
+
+  def update(self, handle, obj):
+    return pypureomapi.OmapiMessage(opcode=pypureomapi.OMAPI_OP_UPDATE, handle=handle, obj=list(obj.items()))
+
+  def dispatch(self, handler, msg):
+    message = dict(msg.message)
+    obj = dict(msg.obj)
+    with self.lock:
+      if msg.opcode == pypureomapi.OMAPI_OP_OPEN and message.get(b'type') == b'authenticator':
+        authenticator = pypureomapi.OmapiHMACMD5Authenticator(self.keyName, self.keyValue)
+        authenticator.authid = len(handler.authenticators)
+        handler.authenticators[authenticator.authid] = authenticator
+        response = self.update(authenticator.authid, {})
+        handler.authid = authenticator.authid
+        return response
+
+      if not msg.verify(handler.authenticators):
+        return self.status(error=True)
+
+      if msg.opcode == pypureomapi.OMAPI_OP_OPEN and message.get(b'type') == b'host':
+        self.stats['open'] += 1
+        mac = obj.get(b'hardware-address')
+        handle = self.hosts.get(mac)
+        if message.get(b'create') == struct.pack('!I', 1):
+          if handle is not None and message.get(b'exclusive') == struct.pack('!I', 1):
+            return self.status(error=True)
+          handle = self.nextHandle
+          self.nextHandle += 1
+          self.hosts[mac] = handle
+          self.handles[handle] = dict(obj)
+          self.commits.append((time.time(), pypureomapi.unpack_mac(mac)))
+          self.stats['create'] += 1
+          return self.update(handle, obj)
+        if handle is None:
+          return self.status(error=True)
+        return self.update(handle, self.handles[handle])
+
+      if msg.opcode == pypureomapi.OMAPI_OP_UPDATE and msg.handle in self.handles:
+        self.stats['update'] += 1
+        if self.rejectStatementUpdates and b'statements' in obj and b'statements' in self.handles[msg.handle]:
+          return self.status(error=True)
+        self.handles[msg.handle].update(obj)
+        self.commits.append((time.time(), pypureomapi.unpack_mac(self.handles[msg.handle][b'hardware-address'])))
+        return self.update(msg.handle, self.handles[msg.handle])
+
+      if msg.opcode == pypureomapi.OMAPI_OP_DELETE and msg.handle in self.handles:
+        self.stats['delete'] += 1
+        obj = self.handles.pop(msg.handle)
+        del self.hosts[obj[b'hardware-address']]
+        return self.status()
+
+      return self.status(error=True)
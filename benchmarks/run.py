@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+# Drive the vmware2dhcp event loop against in-process vCenter and dhcpd stand-ins and report its performance
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vmware2dhcp.vmware2dhcp as core
+from fakevsphere import FakeVSphere
+from omapistub import OmapiStub
+from pyVmomi import vim # See https://github.com/vmware/pyvmomi pylint: disable=no-name-in-module
+
+KEY_NAME = 'bench'
+KEY_VALUE = 'YmVuY2htYXJrLW9ubHktc2VjcmV0'
+
+MIXES = ['create', 'reconfigure-storm', 'many-nics', 'windows', 'unmanaged', 'mixed']
+
+logger = logging.getLogger('benchmark')
+
+
+class BenchVmware2dhcp(core.Vmware2dhcp):
+  def __init__(self, cfg, vsphere, dhcpTargets=None, workers=None):
+    super(BenchVmware2dhcp, self).__init__(cfg, dhcpTargets, workers)
+    self.vsphere = vsphere
+
+  def connect(self):
+    return self.vsphere.serviceInstance()
+
+  def disconnect(self, si):
+    pass
+
+
+def parseArgs():
+  parser = argparse.ArgumentParser(description='Offline vmware2dhcp benchmark')
+  parser.add_argument('--mix', choices=MIXES, default='mixed', help='Event mix (default: %(default)s)')
+  parser.add_argument('--vms', type=int, default=500, help='Number of virtual machines (default: %(default)s)')
+  parser.add_argument('--nics', type=int, default=8, help='NICs of each VM of the many-nics mix (default: %(default)s)')
+  parser.add_argument('--storm', type=int, default=10, help='Reconfigure events per VM of the reconfigure-storm mix (default: %(default)s)')
+  parser.add_argument('--rate', type=float, default=0, help='Published events per second, 0 publishes everything at once (default: %(default)s)')
+  parser.add_argument('--vc-latency', type=float, default=0.005, help='Latency of each vCenter call, in seconds (default: %(default)s)')
+  parser.add_argument('--dhcp-latency', type=float, default=0.001, help='Latency of each OMAPI reply, in seconds (default: %(default)s)')
+  parser.add_argument('--workers', type=int, default=4, help='Registration workers (default: %(default)s)')
+  parser.add_argument('--pool-size', type=int, default=4, help='OMAPI sessions (default: %(default)s)')
+  parser.add_argument('--coalesce-window', type=float, default=0, help='Event coalescing window, in seconds (default: %(default)s)')
+  parser.add_argument('--poll-interval', type=float, default=0.05, help='Time between two event reads right after events were received, in seconds (default: %(default)s)')
+  parser.add_argument('--max-poll-interval', type=float, default=1, help='Maximum idle time between two event reads, in seconds (default: %(default)s)')
+  parser.add_argument('--rules', help='YAML file holding the vm_rules to filter VMs with')
+  parser.add_argument('--timeout', type=float, default=300, help='Give up after that many seconds (default: %(default)s)')
+  parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+  parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+  parser.add_argument('--tolerance', type=float, default=0.2, help='Accepted regression against the baseline (default: %(default)s)')
+  parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help='Log level (default: %(default)s)')
+  return parser.parse_args()
+
+def buildScenario(vsphere, args):
+  # Returns the events to publish, in order, and the VMs expected to end up in the DHCP server
+  steps = []
+  expected = []
+  storms = []
+  filtered = 0
+  for idx in range(args.vms):
+    mix = MIXES[idx % (len(MIXES) - 1)] if args.mix == 'mixed' else args.mix
+    name = 'bench{0}.example.com'.format(idx)
+    if mix in ['windows', 'unmanaged']:
+      filtered += 1
+    # half of the windows and unmanaged mix VMs must be filtered out: Windows guests or names that are not FQDNs
+    if mix == 'windows' and filtered % 2 == 1:
+      vm = vsphere.addVm(name, guestId='windows9Server64Guest')
+    elif mix == 'unmanaged' and filtered % 2 == 1:
+      vm = vsphere.addVm('scratch-{0}'.format(idx))
+    else:
+      vm = vsphere.addVm(name, nics=args.nics if mix == 'many-nics' else 1)
+      expected.append(vm)
+    steps.append((vim.event.VmCreatedEvent, vm))
+    if mix == 'reconfigure-storm':
+      storms.append(vm)
+    else:
+      steps.append((vim.event.VmPoweredOnEvent, vm))
+  # Storms hit every VM at once, the way a bulk reconfiguration does
+  for _ in range(args.storm):
+    for vm in storms:
+      steps.append((vim.event.VmReconfiguredEvent, vm))
+  for vm in storms:
+    steps.append((vim.event.VmPoweredOnEvent, vm))
+  return steps, expected
+
+def percentile(values, ratio):
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, max(0, int(round(ratio * len(values))) - 1))]
+
+def compare(results, baseline, tolerance):
+  regressions = []
+  if results['events_per_second'] < baseline['events_per_second'] * (1 - tolerance):
+    regressions.append('events/sec {0:.1f} < {1:.1f}'.format(results['events_per_second'], baseline['events_per_second']))
+  for key in ['p50', 'p99']:
+    if results['latency_seconds'][key] > baseline['latency_seconds'][key] * (1 + tolerance):
+      regressions.append('{0} latency {1:.3f}s > {2:.3f}s'.format(key, results['latency_seconds'][key], baseline['latency_seconds'][key]))
+  if results['dhcpd']['round_trips_per_vm'] > baseline['dhcpd']['round_trips_per_vm'] * (1 + tolerance):
+    regressions.append('dhcpd round trips per VM {0:.2f} > {1:.2f}'.format(results['dhcpd']['round_trips_per_vm'], baseline['dhcpd']['round_trips_per_vm']))
+  return regressions
+
+def run(args):
+  stub = OmapiStub(KEY_NAME, KEY_VALUE, latency=args.dhcp_latency)
+  stub.serve()
+  vsphere = FakeVSphere(latency=args.vc_latency)
+  steps, expected = buildScenario(vsphere, args)
+
+  # Don't let retries after errors dominate the measured latency
+  core.SLEEP_TIME = args.poll_interval
+  cfg = {
+    'checkpoint_file': '',
+    'dhcp_address': '127.0.0.1',
+    'dhcp_group': None,
+    'dhcp_key_name': KEY_NAME,
+    'dhcp_key_value': KEY_VALUE,
+    'dhcp_pool_size': args.pool_size,
+    'dhcp_port': stub.port,
+    'prom_enabled': False,
+    'prom_port': 0,
+    'reconcile_interval': 0,
+    'reconcile_on_startup': False,
+    'vc_address': 'fake-vcenter',
+    'vc_customattribute_cache_ttl': 300,
+    'vc_customattribute_dhcpoption_namespace': 'dhcp.',
+    'vc_event_coalesce_window': args.coalesce_window,
+    'vc_event_mode': 'poll',
+    'vc_max_inflight': 2,
+    'vc_password': '',
+    'vc_poll_max_interval': args.max_poll_interval,
+    'vc_poll_min_interval': args.poll_interval,
+    'vc_slow_latency': 2,
+    'vc_username': '',
+    'vm_networks': ['PROVISIONING_NETWORK'],
+    'vm_rules': {},
+    'workers': args.workers,
+  }
+  if args.rules:
+    with open(args.rules, 'r') as fh:
+      cfg['vm_rules'] = yaml.load(fh, Loader=yaml.FullLoader)
+  v = BenchVmware2dhcp(cfg, vsphere)
+  thread = threading.Thread(target=v.start, name='vmware2dhcp', daemon=True)
+  thread.start()
+  while not vsphere.stats['CreateCollectorForEvents']:
+    time.sleep(0.01)
+
+  logger.info('Publishing {0} events for {1} VMs'.format(len(steps), args.vms))
+  startTime = time.time()
+  firstEventTime = {}
+  for idx, (eventType, vm) in enumerate(steps):
+    if args.rate > 0:
+      delay = startTime + idx / args.rate - time.time()
+      if delay > 0:
+        time.sleep(delay)
+    event = vsphere.publish(eventType, vm)
+    firstEventTime.setdefault(vm.moId, event.createdTime.timestamp())
+
+  expectedMacs = set(mac for vm in expected for mac in vm.macAddresses)
+  registeredAt = {}
+  seenCommits = 0
+  timedOut = False
+  while True:
+    commits = stub.commits[seenCommits:]
+    seenCommits += len(commits)
+    for commitTime, mac in commits:
+      registeredAt.setdefault(mac, commitTime)
+    if expectedMacs.issubset(registeredAt) and vsphere.readEvents >= len(steps):
+      break
+    if time.time() - startTime > args.timeout:
+      timedOut = True
+      break
+    time.sleep(0.01)
+  # Registrations are asynchronous: the last event read may still be in a worker queue
+  v.stop()
+  thread.join(args.timeout)
+  endTime = max([startTime] + [registeredAt[mac] for mac in expectedMacs if mac in registeredAt])
+  for dhcpTarget in v.dhcpTargets:
+    dhcpTarget.pool.close()
+  v.workers.close()
+  stub.shutdown()
+
+  latencies = []
+  for vm in expected:
+    if all(mac in registeredAt for mac in vm.macAddresses):
+      latencies.append(max(registeredAt[mac] for mac in vm.macAddresses) - firstEventTime[vm.moId])
+  elapsed = endTime - startTime
+  return {
+    'version': core.__version__,
+    'scenario': {
+      'mix': args.mix,
+      'vms': args.vms,
+      'nics': args.nics,
+      'storm': args.storm,
+      'rate': args.rate,
+      'vc_latency': args.vc_latency,
+      'dhcp_latency': args.dhcp_latency,
+      'workers': args.workers,
+      'pool_size': args.pool_size,
+      'coalesce_window': args.coalesce_window,
+      'poll_interval': args.poll_interval,
+      'max_poll_interval': args.max_poll_interval,
+    },
+    'timed_out': timedOut,
+    'events': len(steps),
+    'expected_vms': len(expected),
+    'registered_vms': len(latencies),
+    'elapsed_seconds': elapsed,
+    'events_per_second': len(steps) / elapsed if elapsed > 0 else 0,
+    'latency_seconds': {
+      'p50': percentile(latencies, 0.5),
+      'p99': percentile(latencies, 0.99),
+      'max': max(latencies) if latencies else None,
+    },
+    'dhcpd': {
+      # session setup (startup message and authentication) is included
+      'round_trips': stub.stats['roundtrips'],
+      'round_trips_per_vm': stub.stats['roundtrips'] / len(expected) if expected else 0,
+      'messages_per_vm': stub.stats['messages'] / len(expected) if expected else 0,
+      'opens': stub.stats['open'],
+      'creates': stub.stats['create'],
+      'updates': stub.stats['update'],
+      'deletes': stub.stats['delete'],
+    },
+    'vsphere': dict(vsphere.stats),
+  }
+
+def main():
+  args = parseArgs()
+  logging.basicConfig(level=args.log_level, format='[%(name)s] %(asctime)s %(filename)s %(funcName)s(%(lineno)d): %(message)s')
+  results = run(args)
+
+  output = json.dumps(results, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as fh:
+      fh.write(output + '\n')
+  else:
+    print(output)
+
+  if results['timed_out']:
+    sys.exit('Benchmark timed out: {0}/{1} VMs registered'.format(results['registered_vms'], results['expected_vms']))
+  if args.baseline:
+    with open(args.baseline, 'r') as fh:
+      regressions = compare(results, json.load(fh), args.tolerance)
+    if regressions:
+      sys.exit('Performance regression: {0}'.format(', '.join(regressions)))
+
+if __name__ == '__main__':
+  main()
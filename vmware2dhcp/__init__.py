@@ -1,2 +1,2 @@
 name = 'vmware2dhcp'
-from .vmware2dhcp import Vmware2dhcp
\ No newline at end of file
+from .vmware2dhcp import DryRunTarget, Supervisor, Vmware2dhcp
\ No newline at end of file
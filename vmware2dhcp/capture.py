@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import gzip
+import json
+import logging
+import threading
+import zlib
+from datetime import datetime
+from pyVmomi import vim # See https://github.com/vmware/pyvmomi pylint: disable=no-name-in-module
+from .inventory import VmSnapshot
+
+# Captures are gzip compressed JSON lines, flushed after each record so that a crash loses at most the last one
+CAPTURE_FORMAT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+def serializeEvent(event):
+  record = {
+    'type': event.__class__.__name__,
+    'key': event.key,
+    'createdTime': event.createdTime.isoformat(),
+    'message': event.fullFormattedMessage,
+  }
+  vm = getattr(event, 'vm', None)
+  if vm is not None:
+    record['vm'] = vm.vm._moId
+    record['vmName'] = vm.name
+  if isinstance(event, vim.event.VmRenamedEvent):
+    record['oldName'] = event.oldName
+    record['newName'] = event.newName
+  return record
+
+def deserializeEvent(record):
+  event = getattr(vim.event, record['type'].rsplit('.', 1)[-1])(
+    key=record['key'],
+    chainId=record['key'],
+    createdTime=datetime.fromisoformat(record['createdTime']),
+    fullFormattedMessage=record.get('message'),
+  )
+  if 'vm' in record:
+    event.vm = vim.event.VmEventArgument(vm=vim.VirtualMachine(record['vm']), name=record.get('vmName'))
+  if 'newName' in record:
+    event.oldName = record['oldName']
+    event.newName = record['newName']
+  return event
+
+def serializeSnapshot(vm):
+  return {
+    'hasConfig': vm.hasConfig,
+    'name': vm.name,
+    'guestId': vm.guestId,
+    'devices': vm.devices,
+    'macAddresses': vm.macAddresses,
+    'networks': vm.networks,
+    'customValues': vm.customValues,
+    'folder': vm.folder,
+    'resourcePool': vm.resourcePool,
+  }
+
+def deserializeSnapshot(moId, record):
+  vm = VmSnapshot(vim.VirtualMachine(moId))
+  vm.hasConfig = record['hasConfig']
+  vm.name = record['name']
+  vm.guestId = record['guestId']
+  vm.devices = record['devices']
+  vm.macAddresses = record['macAddresses']
+  vm.networks = record['networks']
+  # JSON object keys are strings, custom field keys are integers
+  vm.customValues = dict((int(key), value) for key, value in record['customValues'].items())
+  vm.folder = record.get('folder')
+  vm.resourcePool = record.get('resourcePool')
+  return vm
+
+
+class CapturePage():
+  __slots__ = ['time', 'events', 'vms', 'customFields', 'attributeKeys']
+
+  def __init__(self, time, events, vms, customFields, attributeKeys):
+    self.time = time
+    self.events = events
+    self.vms = vms
+    self.customFields = customFields
+    self.attributeKeys = attributeKeys
+
+
+class CaptureWriter():
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.customFields = None
+    self.attributeKeys = None
+    self.fh = gzip.open(path, 'ab')
+    self.write({'type': 'header', 'version': CAPTURE_FORMAT_VERSION})
+
+  def write(self, record):
+    self.fh.write(json.dumps(record, separators=(',', ':')).encode('utf8') + b'\n')
+    self.fh.flush(zlib.Z_SYNC_FLUSH)
+
+  def writePage(self, readTime, events, vms, customFields, attributeKeys):
+    with self.lock:
+      # The custom attribute catalogue hardly ever changes: only record it when it does
+      if customFields != self.customFields or attributeKeys != self.attributeKeys:
+        self.write({'type': 'customFields', 'fields': customFields, 'keys': attributeKeys})
+        self.customFields = dict(customFields)
+        self.attributeKeys = dict(attributeKeys)
+      self.write({
+        'type': 'page',
+        'time': readTime,
+        'events': [serializeEvent(event) for event in events],
+        'vms': dict((moId, serializeSnapshot(vm)) for moId, vm in vms.items()),
+      })
+
+  def close(self):
+    with self.lock:
+      if self.fh is not None:
+        self.fh.close()
+        self.fh = None
+
+
+def readCapture(path):
+  customFields = {}
+  attributeKeys = {}
+  with gzip.open(path, 'rb') as fh:
+    try:
+      for line in fh:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          logger.warning('Ignoring truncated capture record in {0}'.format(path))
+          return
+        if record['type'] == 'header':
+          if record['version'] != CAPTURE_FORMAT_VERSION:
+            raise ValueError('Unsupported capture format version {0}'.format(record['version']))
+        elif record['type'] == 'customFields':
+          customFields = dict((int(key), value) for key, value in record['fields'].items())
+          attributeKeys = record.get('keys') or {}
+        elif record['type'] == 'page':
+          yield CapturePage(
+            record['time'],
+            [deserializeEvent(event) for event in record['events']],
+            dict((moId, deserializeSnapshot(moId, vm)) for moId, vm in record['vms'].items()),
+            customFields,
+            attributeKeys,
+          )
+    except EOFError:
+      # The service was stopped while appending to the capture
+      logger.warning('Capture {0} ends with an incomplete record'.format(path))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def atomicWrite(path, data):
+  # Readers see either the previous or the new content, never a partially written file
+  tmpPath = '{0}.tmp'.format(path)
+  with open(tmpPath, 'wb') as fh:
+    fh.write(data)
+    fh.flush()
+    os.fsync(fh.fileno())
+  os.replace(tmpPath, path)
+  try:
+    dirFd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(dirFd)
+  except OSError:
+    pass
+  finally:
+    os.close(dirFd)
+
+
+class FileCheckpointStore():
+  # vcenter identifies the vCenter whose event keys are checkpointed: keys start over on another (or a reinstalled) vCenter
+  def __init__(self, path, flushInterval=5, vcenter=None):
+    self.path = path
+    self.flushInterval = flushInterval
+    self.vcenter = vcenter
+    self.key = None
+    self.createdTime = None
+    self.dirty = False
+    self.lastFlush = 0
+
+  def load(self):
+    try:
+      with open(self.path, 'r') as fh:
+        data = json.load(fh)
+    except FileNotFoundError:
+      logger.info('No event checkpoint found in {0}'.format(self.path))
+      return None, None
+    except (OSError, ValueError) as e:
+      logger.error('Ignoring unreadable event checkpoint {0}: {1}'.format(self.path, e))
+      return None, None
+    if data.get('vcenter') != self.vcenter:
+      logger.warning('Ignoring event checkpoint {0} of another vCenter ({1})'.format(self.path, data.get('vcenter')))
+      return None, None
+    self.key = data.get('key')
+    self.createdTime = datetime.fromisoformat(data['createdTime']) if data.get('createdTime') else None
+    logger.info('Loaded event checkpoint: key {0} at {1}'.format(self.key, self.createdTime))
+    return self.key, self.createdTime
+
+  def update(self, key, createdTime):
+    if self.key is not None and key <= self.key:
+      return
+    self.key = key
+    self.createdTime = createdTime
+    self.dirty = True
+
+  def due(self):
+    return self.dirty and time.time() - self.lastFlush >= self.flushInterval
+
+  def flush(self):
+    if not self.dirty:
+      return
+    atomicWrite(self.path, json.dumps({'vcenter': self.vcenter, 'key': self.key, 'createdTime': self.createdTime.isoformat()}).encode('utf8'))
+    self.dirty = False
+    self.lastFlush = time.time()
@@ -9,23 +9,53 @@ import argparse
 import logging
 import os
 import sys
-from vmware2dhcp import Vmware2dhcp
+if __name__ == '__main__' and not __package__:
+  # Run as a plain script: import the vmware2dhcp package rather than the module of the same name next to this file
+  sys.path[0] = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+from vmware2dhcp import DryRunTarget, Supervisor, Vmware2dhcp
 import yaml
 import pkg_resources
 
 # default values
+DEFAULT_CAPTURE_FILE = ''
+DEFAULT_CHECKPOINT_FILE = ''
+DEFAULT_CHECKPOINT_FLUSH_INTERVAL = 5
+DEFAULT_CHECKPOINT_MAX_CATCHUP = 3600
 DEFAULT_DHCP_ADDRESS = 'localhost'
 DEFAULT_DHCP_GROUP = ''
 DEFAULT_DHCP_KEY_NAME = 'omapi_key'
 DEFAULT_DHCP_KEY_VALUE = 'REVGQVVMVF9ESENQX0tFWV9WQUxVRQ=='
 DEFAULT_DHCP_PORT = 7991
+DEFAULT_DHCP_POOL_SIZE = 4
+DEFAULT_DHCP_TIMEOUT = 10
 DEFAULT_PROM_ENABLED = True
 DEFAULT_PROM_PORT = 8000
+DEFAULT_PROM_PROFILING_ENABLED = False
+DEFAULT_RECONCILE_INTERVAL = 0
+DEFAULT_RECONCILE_ON_STARTUP = True
+DEFAULT_SHARD_COUNT = 0
+DEFAULT_SHARD_LEASE_BACKEND = 'directory'
+DEFAULT_SHARD_LEASE_DIR = ''
+DEFAULT_SHARD_LEASE_TTL = 30
+DEFAULT_SHARD_MEMBER = ''
+DEFAULT_SOURCES = []
+DEFAULT_TRACE_SAMPLE_RATE = 0
 DEFAULT_VC_ADDRESS = 'localhost'
+DEFAULT_VC_CUSTOMATTRIBUTE_CACHE_TTL = 300
 DEFAULT_VC_CUSTOMATTRIBUTE_DHCPOPTION_NAMESPACE = 'dhcp.'
+DEFAULT_VC_EVENT_COALESCE_WINDOW = 0
+DEFAULT_VC_EVENT_MODE = 'poll'
+DEFAULT_VC_MAX_INFLIGHT = 2
 DEFAULT_VC_PASSWORD = 'password'
+DEFAULT_VC_POLL_MAX_INTERVAL = 30
+DEFAULT_VC_POLL_MIN_INTERVAL = 0.5
+DEFAULT_VC_SLOW_LATENCY = 2
 DEFAULT_VC_USERNAME = 'admin'
+DEFAULT_VM_INDEX_FILE = ''
+DEFAULT_VM_INDEX_SWEEP_INTERVAL = 3600
 DEFAULT_VM_NETWORKS = []
+DEFAULT_VM_RULES = {}
+DEFAULT_WORKERS = 4
 
 # List of supported log level stanza for this app
 _LOG_LEVEL_STRINGS = ['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG']
@@ -45,12 +75,20 @@ def _log_level_string_to_int(log_level_string):
 
   return log_level_int
 
+def _bool_string_to_bool(bool_string):
+  return bool_string.strip().lower() in ['1', 'true', 'yes', 'on']
+
 def parseArgs():
   global args
   parser = argparse.ArgumentParser(description='Populate isc-dhcp-server with VMs living in a VMware environment')
   parser.add_argument('-c', '--config', dest='configfile', help='Config file')
   parser.add_argument('-l', '--log-level', default='INFO', type=_log_level_string_to_int, dest='log_level', help='Set the logging output level: {0}'.format(_LOG_LEVEL_STRINGS))
   parser.add_argument('--version', action='version', version=__version__)
+  subparsers = parser.add_subparsers(dest='command')
+  replayParser = subparsers.add_parser('replay', help='Replay an event capture (see capture_file) through the filter and registration pipeline')
+  replayParser.add_argument('capturefile', help='Capture file')
+  replayParser.add_argument('-s', '--speed', default=1, type=float, help='Replay speed factor, 0 replays as fast as possible (default: 1, real time)')
+  replayParser.add_argument('-n', '--dry-run', action='store_true', dest='dry_run', help='Only log the DHCP registrations instead of sending them to the DHCP server')
   args = parser.parse_args()
 
 def loadConfiguration():
@@ -66,18 +104,45 @@ def loadConfiguration():
       sys.exit('Can\'t open config file: {0}'.format(e))
 
   cfg={
+    'capture_file': os.environ['V2D_CAPTURE_FILE'] if 'V2D_CAPTURE_FILE' in os.environ else (configfiledata['capture_file'] if 'capture_file' in configfiledata else DEFAULT_CAPTURE_FILE ),
+    'checkpoint_file': os.environ['V2D_CHECKPOINT_FILE'] if 'V2D_CHECKPOINT_FILE' in os.environ else (configfiledata['checkpoint_file'] if 'checkpoint_file' in configfiledata else DEFAULT_CHECKPOINT_FILE ),
+    'checkpoint_flush_interval': float(os.environ['V2D_CHECKPOINT_FLUSH_INTERVAL']) if 'V2D_CHECKPOINT_FLUSH_INTERVAL' in os.environ else (configfiledata['checkpoint_flush_interval'] if 'checkpoint_flush_interval' in configfiledata else DEFAULT_CHECKPOINT_FLUSH_INTERVAL ),
+    'checkpoint_max_catchup': int(os.environ['V2D_CHECKPOINT_MAX_CATCHUP']) if 'V2D_CHECKPOINT_MAX_CATCHUP' in os.environ else (configfiledata['checkpoint_max_catchup'] if 'checkpoint_max_catchup' in configfiledata else DEFAULT_CHECKPOINT_MAX_CATCHUP ),
     'dhcp_address': os.environ['V2D_DHCP_ADDRESS'] if 'V2D_DHCP_ADDRESS' in os.environ else (configfiledata['dhcp_address'] if 'dhcp_address' in configfiledata else DEFAULT_DHCP_ADDRESS ),
     'dhcp_group': os.environ['V2D_DHCP_GROUP'] if 'V2D_DHCP_GROUP' in os.environ else (configfiledata['dhcp_group'] if 'dhcp_group' in configfiledata else DEFAULT_DHCP_GROUP ),
     'dhcp_key_name': os.environ['V2D_DHCP_KEY_NAME'] if 'V2D_DHCP_KEY_NAME' in os.environ else (configfiledata['dhcp_key_name'] if 'dhcp_key_name' in configfiledata else DEFAULT_DHCP_KEY_NAME ),
     'dhcp_key_value': os.environ['V2D_DHCP_KEY_VALUE'] if 'V2D_DHCP_KEY_VALUE' in os.environ else (configfiledata['dhcp_key_value'] if 'dhcp_key_value' in configfiledata else DEFAULT_DHCP_KEY_VALUE ),
+    'dhcp_pool_size': int(os.environ['V2D_DHCP_POOL_SIZE']) if 'V2D_DHCP_POOL_SIZE' in os.environ else (configfiledata['dhcp_pool_size'] if 'dhcp_pool_size' in configfiledata else DEFAULT_DHCP_POOL_SIZE ),
     'dhcp_port': os.environ['V2D_DHCP_PORT'] if 'V2D_DHCP_PORT' in os.environ else (configfiledata['dhcp_port'] if 'dhcp_port' in configfiledata else DEFAULT_DHCP_PORT ),
+    'dhcp_timeout': float(os.environ['V2D_DHCP_TIMEOUT']) if 'V2D_DHCP_TIMEOUT' in os.environ else (configfiledata['dhcp_timeout'] if 'dhcp_timeout' in configfiledata else DEFAULT_DHCP_TIMEOUT ),
     'prom_enabled': os.environ['V2D_PROM_ENABLED'] if 'V2D_PROM_ENABLED' in os.environ else (configfiledata['prom_enabled'] if 'prom_enabled' in configfiledata else DEFAULT_PROM_ENABLED ),
     'prom_port': os.environ['V2D_PROM_PORT'] if 'V2D_PROM_PORT' in os.environ else (configfiledata['prom_port'] if 'prom_port' in configfiledata else DEFAULT_PROM_PORT ),
+    'prom_profiling_enabled': _bool_string_to_bool(os.environ['V2D_PROM_PROFILING_ENABLED']) if 'V2D_PROM_PROFILING_ENABLED' in os.environ else (configfiledata['prom_profiling_enabled'] if 'prom_profiling_enabled' in configfiledata else DEFAULT_PROM_PROFILING_ENABLED ),
+    'reconcile_interval': int(os.environ['V2D_RECONCILE_INTERVAL']) if 'V2D_RECONCILE_INTERVAL' in os.environ else (configfiledata['reconcile_interval'] if 'reconcile_interval' in configfiledata else DEFAULT_RECONCILE_INTERVAL ),
+    'reconcile_on_startup': _bool_string_to_bool(os.environ['V2D_RECONCILE_ON_STARTUP']) if 'V2D_RECONCILE_ON_STARTUP' in os.environ else (configfiledata['reconcile_on_startup'] if 'reconcile_on_startup' in configfiledata else DEFAULT_RECONCILE_ON_STARTUP ),
+    'shard_count': int(os.environ['V2D_SHARD_COUNT']) if 'V2D_SHARD_COUNT' in os.environ else (configfiledata['shard_count'] if 'shard_count' in configfiledata else DEFAULT_SHARD_COUNT ),
+    'shard_lease_backend': os.environ['V2D_SHARD_LEASE_BACKEND'] if 'V2D_SHARD_LEASE_BACKEND' in os.environ else (configfiledata['shard_lease_backend'] if 'shard_lease_backend' in configfiledata else DEFAULT_SHARD_LEASE_BACKEND ),
+    'shard_lease_dir': os.environ['V2D_SHARD_LEASE_DIR'] if 'V2D_SHARD_LEASE_DIR' in os.environ else (configfiledata['shard_lease_dir'] if 'shard_lease_dir' in configfiledata else DEFAULT_SHARD_LEASE_DIR ),
+    'shard_lease_ttl': float(os.environ['V2D_SHARD_LEASE_TTL']) if 'V2D_SHARD_LEASE_TTL' in os.environ else (configfiledata['shard_lease_ttl'] if 'shard_lease_ttl' in configfiledata else DEFAULT_SHARD_LEASE_TTL ),
+    'shard_member': os.environ['V2D_SHARD_MEMBER'] if 'V2D_SHARD_MEMBER' in os.environ else (configfiledata['shard_member'] if 'shard_member' in configfiledata else DEFAULT_SHARD_MEMBER ),
+    'sources': configfiledata['sources'] if 'sources' in configfiledata else DEFAULT_SOURCES,
+    'trace_sample_rate': float(os.environ['V2D_TRACE_SAMPLE_RATE']) if 'V2D_TRACE_SAMPLE_RATE' in os.environ else (configfiledata['trace_sample_rate'] if 'trace_sample_rate' in configfiledata else DEFAULT_TRACE_SAMPLE_RATE ),
     'vc_address': os.environ['V2D_VC_ADDRESS'] if 'V2D_VC_ADDRESS' in os.environ else (configfiledata['vc_address'] if 'vc_address' in configfiledata else DEFAULT_VC_ADDRESS ),
+    'vc_customattribute_cache_ttl': int(os.environ['V2D_VC_CUSTOMATTRIBUTE_CACHE_TTL']) if 'V2D_VC_CUSTOMATTRIBUTE_CACHE_TTL' in os.environ else (configfiledata['vc_customattribute_cache_ttl'] if 'vc_customattribute_cache_ttl' in configfiledata else DEFAULT_VC_CUSTOMATTRIBUTE_CACHE_TTL ),
     'vc_customattribute_dhcpoption_namespace': os.environ['V2D_VC_CUSTOMATTRIBUTE_DHCPOPTION_NAMESPACE'] if 'V2D_VC_CUSTOMATTRIBUTE_DHCPOPTION_NAMESPACE' in os.environ else (configfiledata['vc_customattribute_dhcpoption_namespace'] if 'vc_customattribute_dhcpoption_namespace' in configfiledata else DEFAULT_VC_CUSTOMATTRIBUTE_DHCPOPTION_NAMESPACE ),
+    'vc_event_coalesce_window': float(os.environ['V2D_VC_EVENT_COALESCE_WINDOW']) if 'V2D_VC_EVENT_COALESCE_WINDOW' in os.environ else (configfiledata['vc_event_coalesce_window'] if 'vc_event_coalesce_window' in configfiledata else DEFAULT_VC_EVENT_COALESCE_WINDOW ),
+    'vc_event_mode': os.environ['V2D_VC_EVENT_MODE'] if 'V2D_VC_EVENT_MODE' in os.environ else (configfiledata['vc_event_mode'] if 'vc_event_mode' in configfiledata else DEFAULT_VC_EVENT_MODE ),
+    'vc_max_inflight': int(os.environ['V2D_VC_MAX_INFLIGHT']) if 'V2D_VC_MAX_INFLIGHT' in os.environ else (configfiledata['vc_max_inflight'] if 'vc_max_inflight' in configfiledata else DEFAULT_VC_MAX_INFLIGHT ),
     'vc_password': os.environ['V2D_VC_PASSWORD'] if 'V2D_VC_PASSWORD' in os.environ else (configfiledata['vc_password'] if 'vc_password' in configfiledata else DEFAULT_VC_PASSWORD ),
+    'vc_poll_max_interval': float(os.environ['V2D_VC_POLL_MAX_INTERVAL']) if 'V2D_VC_POLL_MAX_INTERVAL' in os.environ else (configfiledata['vc_poll_max_interval'] if 'vc_poll_max_interval' in configfiledata else DEFAULT_VC_POLL_MAX_INTERVAL ),
+    'vc_poll_min_interval': float(os.environ['V2D_VC_POLL_MIN_INTERVAL']) if 'V2D_VC_POLL_MIN_INTERVAL' in os.environ else (configfiledata['vc_poll_min_interval'] if 'vc_poll_min_interval' in configfiledata else DEFAULT_VC_POLL_MIN_INTERVAL ),
+    'vc_slow_latency': float(os.environ['V2D_VC_SLOW_LATENCY']) if 'V2D_VC_SLOW_LATENCY' in os.environ else (configfiledata['vc_slow_latency'] if 'vc_slow_latency' in configfiledata else DEFAULT_VC_SLOW_LATENCY ),
     'vc_username': os.environ['V2D_VC_USERNAME'] if 'V2D_VC_USERNAME' in os.environ else (configfiledata['vc_username'] if 'vc_username' in configfiledata else DEFAULT_VC_USERNAME ),
+    'vm_index_file': os.environ['V2D_VM_INDEX_FILE'] if 'V2D_VM_INDEX_FILE' in os.environ else (configfiledata['vm_index_file'] if 'vm_index_file' in configfiledata else DEFAULT_VM_INDEX_FILE ),
+    'vm_index_sweep_interval': int(os.environ['V2D_VM_INDEX_SWEEP_INTERVAL']) if 'V2D_VM_INDEX_SWEEP_INTERVAL' in os.environ else (configfiledata['vm_index_sweep_interval'] if 'vm_index_sweep_interval' in configfiledata else DEFAULT_VM_INDEX_SWEEP_INTERVAL ),
     'vm_networks': os.environ['V2D_VM_NETWORKS'].split(',') if 'V2D_VM_NETWORKS' in os.environ else (configfiledata['vm_networks'] if 'vm_networks' in configfiledata else DEFAULT_VM_NETWORKS ),
+    'vm_rules': configfiledata['vm_rules'] if 'vm_rules' in configfiledata else DEFAULT_VM_RULES,
+    'workers': int(os.environ['V2D_WORKERS']) if 'V2D_WORKERS' in os.environ else (configfiledata['workers'] if 'workers' in configfiledata else DEFAULT_WORKERS ),
   }
   return cfg
 
@@ -88,7 +153,14 @@ def run():
   parseArgs()
   setLoglevel()
   cfg = loadConfiguration()
-  v = Vmware2dhcp(cfg)
+  if args.command == 'replay':
+    v = Vmware2dhcp(cfg, [DryRunTarget(cfg)] if args.dry_run else None)
+    v.replay(args.capturefile, args.speed)
+    return
+  if cfg['sources']:
+    v = Supervisor(cfg)
+  else:
+    v = Vmware2dhcp(cfg)
   v.start()
 
 if __name__ == '__main__':
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import logging
+from pyVmomi import vim, vmodl # See https://github.com/vmware/pyvmomi pylint: disable=no-name-in-module
+
+# Virtual machine properties needed to filter and register a VM. Anything else is never read from vCenter
+VM_PROPERTIES = ['config.name', 'config.guestId', 'config.hardware.device', 'customValue', 'network']
+# Only read when a filter rule needs them
+VM_FOLDER_PROPERTY = 'parent'
+VM_RESOURCE_POOL_PROPERTY = 'resourcePool'
+NETWORK_PROPERTIES = ['name']
+
+logger = logging.getLogger(__name__)
+
+
+class VmSnapshot():
+  __slots__ = ['moId', 'ref', 'hasConfig', 'name', 'guestId', 'devices', 'hardwareDevices', '_macAddresses', 'networks', 'customValues', 'folder', 'resourcePool']
+
+  def __init__(self, ref):
+    self.moId = ref._moId
+    self.ref = ref
+    self.hasConfig = False
+    self.name = None
+    self.guestId = None
+    self.devices = None
+    self.hardwareDevices = None
+    self._macAddresses = None
+    self.networks = []
+    self.customValues = {}
+    self.folder = None
+    self.resourcePool = None
+
+  @property
+  def macAddresses(self):
+    # Walking the hardware devices is deferred until a VM gets past the cheaper filter rules
+    if self._macAddresses is None:
+      self._macAddresses = [dev.macAddress for dev in self.hardwareDevices or [] if isinstance(dev, vim.vm.device.VirtualEthernetCard)]
+      self.hardwareDevices = None
+    return self._macAddresses
+
+  @macAddresses.setter
+  def macAddresses(self, macAddresses):
+    self._macAddresses = macAddresses
+    self.hardwareDevices = None
+
+  def __repr__(self):
+    return 'VmSnapshot({0}, name={1}, guestId={2}, macAddresses={3}, networks={4}, customValues={5})'.format(self.moId, self.name, self.guestId, self.macAddresses, self.networks, self.customValues)
+
+
+def vmFilterSpec(objectSet, properties=VM_PROPERTIES):
+  propSet = [
+    vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=properties),
+    vmodl.query.PropertyCollector.PropertySpec(type=vim.Network, pathSet=NETWORK_PROPERTIES),
+  ]
+  if VM_FOLDER_PROPERTY in properties:
+    propSet.append(vmodl.query.PropertyCollector.PropertySpec(type=vim.Folder, pathSet=['name']))
+  if VM_RESOURCE_POOL_PROPERTY in properties:
+    propSet.append(vmodl.query.PropertyCollector.PropertySpec(type=vim.ResourcePool, pathSet=['name']))
+  return vmodl.query.PropertyCollector.FilterSpec(objectSet=objectSet, propSet=propSet)
+
+def vmTraversalSpecs(properties=VM_PROPERTIES):
+  # Walk from a VM to its networks (and folder or resource pool) so that their names come back in the same call
+  selectSet = [vmodl.query.PropertyCollector.TraversalSpec(name='vmToNetwork', type=vim.VirtualMachine, path='network', skip=False)]
+  if VM_FOLDER_PROPERTY in properties:
+    selectSet.append(vmodl.query.PropertyCollector.TraversalSpec(name='vmToFolder', type=vim.VirtualMachine, path=VM_FOLDER_PROPERTY, skip=False))
+  if VM_RESOURCE_POOL_PROPERTY in properties:
+    selectSet.append(vmodl.query.PropertyCollector.TraversalSpec(name='vmToResourcePool', type=vim.VirtualMachine, path=VM_RESOURCE_POOL_PROPERTY, skip=False))
+  return selectSet
+
+def vmObjectSpec(ref, properties=VM_PROPERTIES):
+  return vmodl.query.PropertyCollector.ObjectSpec(obj=ref, skip=False, selectSet=vmTraversalSpecs(properties))
+
+def containerViewObjectSpec(view, properties=VM_PROPERTIES):
+  return vmodl.query.PropertyCollector.ObjectSpec(
+    obj=view,
+    skip=True,
+    selectSet=[vmodl.query.PropertyCollector.TraversalSpec(name='viewToVm', type=vim.view.ContainerView, path='view', skip=False, selectSet=vmTraversalSpecs(properties))]
+  )
+
+def retrieveObjects(propertyCollector, filterSpec):
+  objects = []
+  result = propertyCollector.RetrievePropertiesEx(specSet=[filterSpec], options=vmodl.query.PropertyCollector.RetrieveOptions())
+  while result is not None:
+    objects.extend(result.objects)
+    if not result.token:
+      break
+    result = propertyCollector.ContinueRetrievePropertiesEx(token=result.token)
+  return objects
+
+def buildSnapshots(objects):
+  snapshots = {}
+  # names of the networks, folders and resource pools the VMs point to
+  names = {}
+  vmNetworks = {}
+  vmParents = {}
+
+  for content in objects:
+    if not isinstance(content.obj, vim.VirtualMachine):
+      for prop in content.propSet:
+        if prop.name == 'name':
+          names[content.obj._moId] = prop.val
+      continue
+
+    snapshot = VmSnapshot(content.obj)
+    for prop in content.propSet:
+      if prop.name == 'config.name':
+        snapshot.hasConfig = True
+        snapshot.name = prop.val
+      elif prop.name == 'config.guestId':
+        snapshot.hasConfig = True
+        snapshot.guestId = prop.val
+      elif prop.name == 'config.hardware.device':
+        snapshot.hasConfig = True
+        snapshot.devices = len(prop.val)
+        snapshot.hardwareDevices = prop.val
+      elif prop.name == 'customValue':
+        snapshot.customValues = dict((field.key, field.value) for field in prop.val)
+      elif prop.name == 'network':
+        vmNetworks[snapshot.moId] = [network._moId for network in prop.val]
+      elif prop.name in (VM_FOLDER_PROPERTY, VM_RESOURCE_POOL_PROPERTY) and prop.val is not None:
+        vmParents[(snapshot.moId, prop.name)] = prop.val._moId
+    snapshots[snapshot.moId] = snapshot
+
+  for moId, networks in vmNetworks.items():
+    snapshots[moId].networks = [names[network] for network in networks if network in names]
+  for (moId, prop), parent in vmParents.items():
+    if prop == VM_FOLDER_PROPERTY:
+      snapshots[moId].folder = names.get(parent)
+    else:
+      snapshots[moId].resourcePool = names.get(parent)
+
+  return snapshots
+
+def retrieveVmSnapshots(propertyCollector, vmRefs, properties=VM_PROPERTIES):
+  objectSpecs = {}
+  for ref in vmRefs:
+    objectSpecs[ref._moId] = ref
+  while objectSpecs:
+    try:
+      objects = retrieveObjects(propertyCollector, vmFilterSpec([vmObjectSpec(ref, properties) for ref in objectSpecs.values()], properties))
+    except vmodl.fault.ManagedObjectNotFound as e:
+      # One VM vanished in between (eg. already deleted): retrieve the others without it
+      logger.debug('VM %s no longer exists', e.obj)
+      if e.obj is None or e.obj._moId not in objectSpecs:
+        raise
+      del objectSpecs[e.obj._moId]
+      continue
+    return buildSnapshots(objects)
+  return {}
+
+def retrieveAllVmSnapshots(content, properties=VM_PROPERTIES):
+  view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+  try:
+    return buildSnapshots(retrieveObjects(content.propertyCollector, vmFilterSpec([containerViewObjectSpec(view, properties)], properties)))
+  finally:
+    view.Destroy()
+
+def retrieveAllVmIds(content):
+  # Managed object ids of all the VMs, without any of their properties
+  view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+  try:
+    objects = retrieveObjects(content.propertyCollector, vmodl.query.PropertyCollector.FilterSpec(
+      objectSet=[vmodl.query.PropertyCollector.ObjectSpec(
+        obj=view,
+        skip=True,
+        selectSet=[vmodl.query.PropertyCollector.TraversalSpec(name='viewToVm', type=vim.view.ContainerView, path='view', skip=False)]
+      )],
+      propSet=[vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=[])]
+    ))
+    return set(content.obj._moId for content in objects if isinstance(content.obj, vim.VirtualMachine))
+  finally:
+    view.Destroy()
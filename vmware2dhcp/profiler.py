@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+from prometheus_client import make_wsgi_app
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+
+PROFILE_PATH = '/debug/profile'
+# default and maximum duration (in seconds) of a profile, and default time between two samples
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = 60
+PROFILE_DEFAULT_INTERVAL = 0.01
+
+logger = logging.getLogger(__name__)
+
+_profileLock = threading.Lock()
+
+
+def sampleStacks(seconds, interval):
+  # Statistical profile of every other thread, as collapsed stacks (see flamegraph.pl or speedscope)
+  stacks = collections.Counter()
+  me = threading.get_ident()
+  deadline = time.time() + seconds
+  while time.time() < deadline:
+    threadNames = dict((thread.ident, thread.name) for thread in threading.enumerate())
+    for ident, frame in sys._current_frames().items():
+      if ident == me:
+        continue
+      frames = []
+      while frame is not None:
+        frames.append('{0} ({1})'.format(frame.f_code.co_name, os.path.basename(frame.f_code.co_filename)))
+        frame = frame.f_back
+      frames.append(threadNames.get(ident, str(ident)))
+      stacks[';'.join(reversed(frames))] += 1
+    time.sleep(interval)
+  return stacks
+
+def makeWsgiApp():
+  metricsApp = make_wsgi_app()
+
+  def app(environ, start_response):
+    if environ.get('PATH_INFO') != PROFILE_PATH:
+      return metricsApp(environ, start_response)
+    params = parse_qs(environ.get('QUERY_STRING', ''))
+    try:
+      seconds = min(float(params.get('seconds', [PROFILE_DEFAULT_SECONDS])[0]), PROFILE_MAX_SECONDS)
+      interval = max(float(params.get('interval', [PROFILE_DEFAULT_INTERVAL])[0]), 0.001)
+    except ValueError:
+      start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+      return [b'seconds and interval must be numbers\n']
+    # Sampling is not free: never run two profiles at once
+    if not _profileLock.acquire(blocking=False):
+      start_response('409 Conflict', [('Content-Type', 'text/plain')])
+      return [b'a profile is already running\n']
+    try:
+      logger.info('Profiling for {0}s'.format(seconds))
+      stacks = sampleStacks(seconds, interval)
+    finally:
+      _profileLock.release()
+    start_response('200 OK', [('Content-Type', 'text/plain; charset=utf-8')])
+    return [''.join('{0} {1}\n'.format(stack, count) for stack, count in stacks.most_common()).encode('utf8')]
+
+  return app
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+  daemon_threads = True
+
+
+class _SilentHandler(WSGIRequestHandler):
+  def log_message(self, format, *args):
+    pass
+
+
+def startProfilingHttpServer(port, addr=''):
+  # Same as prometheus_client.start_http_server, with the profiling endpoint next to the metrics
+  httpd = make_server(addr, port, makeWsgiApp(), _ThreadingWSGIServer, handler_class=_SilentHandler)
+  thread = threading.Thread(target=httpd.serve_forever, name='exporter', daemon=True)
+  thread.start()
+  return httpd
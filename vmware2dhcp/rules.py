@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import logging
+import re
+from .inventory import VM_FOLDER_PROPERTY, VM_PROPERTIES, VM_RESOURCE_POOL_PROPERTY
+
+# Rules of a same cost are reordered every that many evaluations, the most selective first
+RULES_REORDER_INTERVAL = 1000
+
+# Rule costs: plain attribute checks, then set lookups, then regular expressions
+COST_ATTRIBUTE = 0
+COST_LOOKUP = 1
+COST_REGEXP = 2
+
+logger = logging.getLogger(__name__)
+
+
+def compilePatterns(patterns):
+  # All the patterns of a list are matched in a single pass
+  if not patterns:
+    return None
+  if isinstance(patterns, str):
+    patterns = [patterns]
+  return re.compile('|'.join('(?:{0})'.format(pattern) for pattern in patterns), re.IGNORECASE)
+
+def attributeValues(values):
+  # vCenter custom values are strings, whatever YAML parsed the configured ones into (eg. 1 or true)
+  if not isinstance(values, list):
+    values = [values]
+  strings = set()
+  for value in values:
+    strings.add(str(value))
+    if isinstance(value, bool):
+      strings.add(str(value).lower())
+  return frozenset(strings)
+
+
+class Rule():
+  __slots__ = ['result', 'cost', 'check', 'evaluations', 'rejections']
+
+  def __init__(self, result, cost, check):
+    # result is the filtering outcome reported when the rule rejects a VM
+    self.result = result
+    self.cost = cost
+    self.check = check
+    self.evaluations = 0
+    self.rejections = 0
+
+  def selectivity(self):
+    return self.rejections / self.evaluations if self.evaluations else 0
+
+  def __repr__(self):
+    return 'Rule({0}, cost={1}, rejected {2}/{3})'.format(self.result, self.cost, self.rejections, self.evaluations)
+
+
+class RuleEngine():
+  def __init__(self, rulesCfg, vmNetworks, fqdnRegexp, unmanagedGuestIdRegexp, attributeKeys=None):
+    # attributeKeys returns the custom attribute keys by name, it is only called by attribute rules
+    self.attributeKeys = attributeKeys
+    self.properties = list(VM_PROPERTIES)
+    self.rules = []
+    self.evaluations = 0
+
+    self.rules.append(Rule('no_vmconfig', COST_ATTRIBUTE, lambda vm: vm.hasConfig))
+    self.rules.append(Rule('no_device', COST_ATTRIBUTE, lambda vm: vm.devices is not None))
+
+    networks = frozenset(rulesCfg.get('networks') or vmNetworks or [])
+    if networks:
+      self.rules.append(Rule('bad_network', COST_LOOKUP, lambda vm: not networks.isdisjoint(vm.networks)))
+
+    folders = frozenset(rulesCfg.get('folders') or [])
+    if folders:
+      self.properties.append(VM_FOLDER_PROPERTY)
+      self.rules.append(Rule('bad_folder', COST_LOOKUP, lambda vm: vm.folder in folders))
+
+    resourcePools = frozenset(rulesCfg.get('resource_pools') or [])
+    if resourcePools:
+      self.properties.append(VM_RESOURCE_POOL_PROPERTY)
+      self.rules.append(Rule('bad_resource_pool', COST_LOOKUP, lambda vm: vm.resourcePool in resourcePools))
+
+    attributes = dict((name, attributeValues(values)) for name, values in (rulesCfg.get('attributes') or {}).items())
+    if attributes:
+      self.rules.append(Rule('bad_attribute', COST_LOOKUP, self.matchAttributes(attributes)))
+
+    guestIds = rulesCfg.get('guest_ids') or {}
+    allowGuestIds = compilePatterns(guestIds.get('allow'))
+    denyGuestIds = compilePatterns(guestIds.get('deny', unmanagedGuestIdRegexp))
+    if allowGuestIds or denyGuestIds:
+      self.rules.append(Rule('unsupported_os', COST_REGEXP, self.matchPatterns(lambda vm: vm.guestId, allowGuestIds, denyGuestIds)))
+
+    names = rulesCfg.get('names') or {}
+    self.matchesName = self.matchName(fqdnRegexp, compilePatterns(names.get('allow')), compilePatterns(names.get('deny')))
+    self.nameRule = Rule('bad_name', COST_REGEXP, lambda vm: self.matchesName(vm.name))
+    self.rules.append(self.nameRule)
+
+    # Walks the hardware devices: only worth it for VMs that passed everything else
+    self.rules.append(Rule('no_network_interface', COST_REGEXP + 1, lambda vm: bool(vm.macAddresses)))
+
+    self.rules.sort(key=lambda rule: rule.cost)
+    logger.info('VM filter rules: {0}'.format([rule.result for rule in self.rules]))
+
+  @staticmethod
+  def matchPatterns(attribute, allow, deny):
+    def check(vm):
+      value = attribute(vm) or ''
+      if deny is not None and deny.match(value):
+        return False
+      return allow is None or allow.match(value) is not None
+    return check
+
+  @staticmethod
+  def matchName(fqdnRegexp, allow, deny):
+    def check(name):
+      name = name or ''
+      if not fqdnRegexp.match(name):
+        return False
+      if deny is not None and deny.match(name):
+        return False
+      return allow is None or allow.match(name) is not None
+    return check
+
+  def matchAttributes(self, attributes):
+    def check(vm):
+      keys = self.attributeKeys() if self.attributeKeys is not None else {}
+      for name, values in attributes.items():
+        if vm.customValues.get(keys.get(name)) not in values:
+          return False
+      return True
+    return check
+
+  def evaluate(self, vm):
+    # Returns the outcome of the first rule rejecting the VM, or 'accepted'. Counters are shared by the workers, hence approximate
+    self.evaluations += 1
+    if self.evaluations % RULES_REORDER_INTERVAL == 0:
+      self.reorder()
+    for rule in self.rules:
+      rule.evaluations += 1
+      if not rule.check(vm):
+        rule.rejections += 1
+        return rule.result
+    return 'accepted'
+
+  def acceptsName(self, name):
+    # Name only check, run on the event itself before any VM property is read from vCenter
+    self.nameRule.evaluations += 1
+    if self.matchesName(name):
+      return True
+    self.nameRule.rejections += 1
+    return False
+
+  def reorder(self):
+    # Stable sort: rules of a same cost keep their configured order until their selectivity differs
+    self.rules = sorted(self.rules, key=lambda rule: (rule.cost, -rule.selectivity()))
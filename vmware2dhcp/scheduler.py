@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import logging
+
+# ReadNextEvents never returns more than 1000 events at once
+MIN_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+# Polling slows down that much after each empty read
+IDLE_BACKOFF = 2
+# Weight of the last vCenter call in the smoothed latency
+LATENCY_SMOOTHING = 0.3
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveScheduler():
+  # Decides how long to wait before reading the next event page, and how many events to ask for
+  def __init__(self, minInterval=0.5, maxInterval=30, slowLatency=2, minPageSize=MIN_PAGE_SIZE, maxPageSize=MAX_PAGE_SIZE):
+    self.minInterval = minInterval
+    self.maxInterval = max(minInterval, maxInterval)
+    self.slowLatency = slowLatency
+    self.minPageSize = minPageSize
+    self.maxPageSize = max(minPageSize, maxPageSize)
+    self.interval = self.minInterval
+    self.pageSize = self.minPageSize
+    # Consecutive empty reads, and the interval enforced while vCenter is slow
+    self.idlePolls = 0
+    self.shedInterval = 0
+    self.latency = None
+    self.overloaded = False
+
+  def observeLatency(self, seconds):
+    # Fed with every vCenter call duration: event reads as well as property retrievals
+    if self.latency is None:
+      self.latency = seconds
+    else:
+      self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+    overloaded = self.slowLatency > 0 and self.latency > self.slowLatency
+    if overloaded != self.overloaded:
+      self.overloaded = overloaded
+      if overloaded:
+        logger.warning('VSphere server is slow ({0:.2f}s per call), shedding load'.format(self.latency))
+      else:
+        logger.info('VSphere server latency is back to {0:.2f}s per call'.format(self.latency))
+
+  def observePage(self, eventCount, pageSize):
+    if eventCount == 0:
+      # The first empty read right after a burst keeps polling fast
+      self.interval = self.minInterval if self.idlePolls == 0 else min(self.maxInterval, self.interval * IDLE_BACKOFF)
+      self.idlePolls += 1
+    else:
+      # Events are flowing: ask for more of them when the page came back full
+      self.interval = self.minInterval
+      self.idlePolls = 0
+      if eventCount >= pageSize and not self.overloaded:
+        self.pageSize = min(self.maxPageSize, self.pageSize * 2)
+      elif eventCount < self.pageSize // 4:
+        self.pageSize = max(self.minPageSize, self.pageSize // 2)
+    if self.overloaded:
+      # Fewer and smaller requests until vCenter recovers, whatever the backlog
+      self.shedInterval = min(self.maxInterval, max(self.minInterval, self.shedInterval * IDLE_BACKOFF))
+      self.pageSize = max(self.minPageSize, self.pageSize // 2)
+      self.interval = max(self.interval, self.shedInterval)
+    else:
+      self.shedInterval = 0
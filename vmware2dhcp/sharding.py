@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from .checkpoint import atomicWrite
+
+# Members gone for that many TTLs are deleted from the lease directory
+LEASE_CLEANUP_TTLS = 10
+
+logger = logging.getLogger(__name__)
+
+
+def shardOf(moId, shardCount):
+  return zlib.crc32(moId.encode('utf8')) % shardCount
+
+def shardOwner(shard, members):
+  # Rendezvous hashing: a membership change only moves the shards of the members that joined or left
+  return max(members, key=lambda member: hashlib.sha1('{0}/{1}'.format(member, shard).encode('utf8')).digest())
+
+
+class DirectoryLeaseBackend():
+  # Leases are files of a directory shared by all the replicas (eg. a ReadWriteMany volume), guarded by an flock
+  def __init__(self, path):
+    self.path = path
+
+  def filePath(self, kind, name):
+    return os.path.join(self.path, kind, re.sub(r'[^A-Za-z0-9_.-]', '_', str(name)))
+
+  @contextlib.contextmanager
+  def locked(self):
+    with open(os.path.join(self.path, '.lock'), 'a') as fh:
+      fcntl.flock(fh, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(fh, fcntl.LOCK_UN)
+
+  def read(self, path):
+    try:
+      with open(path, 'r') as fh:
+        return json.load(fh)
+    except FileNotFoundError:
+      return None
+    except ValueError as e:
+      logger.warning('Ignoring unreadable lease file {0}: {1}'.format(path, e))
+      return None
+
+  def write(self, path, data):
+    atomicWrite(path, json.dumps(data, separators=(',', ':')).encode('utf8'))
+
+  def heartbeat(self, member, ttl):
+    for kind in ['members', 'leases', 'handover']:
+      os.makedirs(os.path.join(self.path, kind), exist_ok=True)
+    self.write(self.filePath('members', member), {'member': member, 'expires': time.time() + ttl, 'ttl': ttl})
+
+  def members(self):
+    members = []
+    now = time.time()
+    for name in os.listdir(os.path.join(self.path, 'members')):
+      path = os.path.join(self.path, 'members', name)
+      record = self.read(path)
+      if record is None:
+        continue
+      if record['expires'] > now:
+        members.append(record['member'])
+      elif record['expires'] < now - LEASE_CLEANUP_TTLS * record['ttl']:
+        with contextlib.suppress(FileNotFoundError):
+          os.remove(path)
+    return members
+
+  def leave(self, member):
+    with contextlib.suppress(FileNotFoundError):
+      os.remove(self.filePath('members', member))
+
+  def acquire(self, shard, member, ttl):
+    with self.locked():
+      path = self.filePath('leases', shard)
+      lease = self.read(path)
+      if lease is not None and lease['member'] != member and lease['expires'] > time.time():
+        return False
+      self.write(path, {'member': member, 'expires': time.time() + ttl})
+      return True
+
+  def renew(self, shard, member, ttl):
+    with self.locked():
+      path = self.filePath('leases', shard)
+      lease = self.read(path)
+      if lease is None or lease['member'] != member:
+        return False
+      self.write(path, {'member': member, 'expires': time.time() + ttl})
+      return True
+
+  def release(self, shard, member):
+    with self.locked():
+      path = self.filePath('leases', shard)
+      lease = self.read(path)
+      if lease is not None and lease['member'] == member:
+        os.remove(path)
+
+  def putState(self, shard, state):
+    # Adds to the state no member took over yet
+    with self.locked():
+      path = self.filePath('handover', shard)
+      previous = self.read(path) or {}
+      previous.update(state)
+      self.write(path, previous)
+
+  def takeState(self, shard):
+    with self.locked():
+      path = self.filePath('handover', shard)
+      state = self.read(path)
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+      return state or {}
+
+
+LEASE_BACKENDS = {
+  'directory': DirectoryLeaseBackend,
+}
+
+
+class ShardManager():
+  def __init__(self, backend, member, shardCount, ttl=30):
+    self.backend = backend
+    self.member = member
+    self.shardCount = shardCount
+    self.ttl = ttl
+    self.renewInterval = ttl / 3.0
+    self.lock = threading.Lock()
+    # Time until which this member may write each of its shards: leases are renewed well before they expire for the others
+    self.leases = {}
+    self.members = [member]
+
+  def shardOf(self, moId):
+    return shardOf(moId, self.shardCount)
+
+  def owns(self, shard):
+    expires = self.leases.get(shard)
+    return expires is not None and time.time() < expires
+
+  def ownedShards(self):
+    now = time.time()
+    with self.lock:
+      return set(shard for shard, expires in self.leases.items() if now < expires)
+
+  def heartbeat(self):
+    self.backend.heartbeat(self.member, self.ttl)
+    with self.lock:
+      shards = list(self.leases)
+    for shard in shards:
+      renewTime = time.time()
+      renewed = self.backend.renew(shard, self.member, self.ttl)
+      with self.lock:
+        if shard not in self.leases:
+          continue
+        if renewed:
+          self.leases[shard] = renewTime + self.ttl - self.renewInterval
+        else:
+          del self.leases[shard]
+          logger.warning('Lost the lease of shard {0}'.format(shard))
+
+  def plan(self):
+    # Returns the shards to acquire and those to release, according to the live members
+    self.members = sorted(set(self.backend.members()) | set([self.member]))
+    desired = set(shard for shard in range(self.shardCount) if shardOwner(shard, self.members) == self.member)
+    with self.lock:
+      owned = set(self.leases)
+    return desired - owned, owned - desired
+
+  def acquire(self, shards):
+    # Shards still leased by their previous owner are retried on the next plan
+    acquired = []
+    for shard in sorted(shards):
+      acquireTime = time.time()
+      if self.backend.acquire(shard, self.member, self.ttl):
+        with self.lock:
+          self.leases[shard] = acquireTime + self.ttl - self.renewInterval
+        acquired.append(shard)
+    return acquired
+
+  def release(self, shards, states=None):
+    # states are handed over to the next owner of each shard
+    for shard in sorted(shards):
+      with self.lock:
+        self.leases.pop(shard, None)
+      if states is not None:
+        self.backend.putState(shard, states.get(shard) or {})
+      self.backend.release(shard, self.member)
+
+  def takeState(self, shard):
+    return self.backend.takeState(shard)
+
+  def leave(self):
+    self.backend.leave(self.member)
+
+
+def createShardManager(cfg):
+  backend = cfg.get('shard_lease_backend', 'directory')
+  if backend not in LEASE_BACKENDS:
+    raise ValueError('Unsupported shard lease backend {0} (choose from {1})'.format(backend, sorted(LEASE_BACKENDS)))
+  if not cfg.get('shard_lease_dir'):
+    raise ValueError('shard_lease_dir is required when sharding is enabled')
+  # State files are named after the member: a name changing on restart (eg. the hostname of a Deployment pod) would lose them
+  if not cfg.get('shard_member'):
+    raise ValueError('shard_member is required when sharding is enabled, and must not change when the replica restarts')
+  # vCenters are sharded independently of each other
+  path = os.path.join(cfg['shard_lease_dir'], cfg['vc_address'])
+  return ShardManager(LEASE_BACKENDS[backend](path), cfg['shard_member'], int(cfg['shard_count']), float(cfg.get('shard_lease_ttl', 30)))
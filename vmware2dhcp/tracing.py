@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import json
+import logging
+import time
+from datetime import datetime
+from pytz import timezone
+
+# Spreads consecutive event keys over the sampling range (Knuth multiplicative hash)
+SAMPLING_MULTIPLIER = 2654435761
+SAMPLING_RANGE = 2 ** 32
+
+logger = logging.getLogger(__name__)
+
+
+class EventTrace():
+  __slots__ = ['record', 'startTime', 'lastTime']
+
+  def __init__(self, event):
+    self.startTime = self.lastTime = time.perf_counter()
+    self.record = {
+      'key': event.key,
+      'event': event.__class__.__name__,
+      'age': round((datetime.now(timezone('UTC')) - event.createdTime).total_seconds(), 6),
+      'stages': {},
+    }
+    if event.vm is not None:
+      self.record['vm'] = event.vm.vm._moId
+      self.record['name'] = event.vm.name
+
+  def stage(self, name):
+    # Time spent since the previous stage
+    now = time.perf_counter()
+    self.record['stages'][name] = round(now - self.lastTime, 6)
+    self.lastTime = now
+
+  def set(self, key, value):
+    self.record[key] = value
+
+  def emit(self):
+    self.record['total'] = round(time.perf_counter() - self.startTime, 6)
+    # Only rendered if the record actually gets logged
+    logger.info('%s', self)
+
+  def __str__(self):
+    return json.dumps(self.record, separators=(',', ':'), default=str)
+
+
+class EventTracer():
+  def __init__(self, sampleRate=0):
+    self.threshold = int(max(0, min(1, sampleRate)) * SAMPLING_RANGE)
+
+  def trace(self, event):
+    # Sampling depends on the event key only: a replayed capture traces the same events
+    if not self.threshold or (event.key * SAMPLING_MULTIPLIER) % SAMPLING_RANGE >= self.threshold:
+      return None
+    return EventTrace(event)
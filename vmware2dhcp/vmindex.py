@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+# Copyright (c) 2019 Jean-Fabrice BOBO
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import json
+import logging
+import threading
+import time
+from .checkpoint import atomicWrite
+
+logger = logging.getLogger(__name__)
+
+
+class VmIndex():
+  # Mac addresses registered for each VM (by managed object id): once a VM is removed from vCenter, they can't be read anymore
+  def __init__(self, path=None, flushInterval=5):
+    self.path = path
+    self.flushInterval = flushInterval
+    self.lock = threading.Lock()
+    self.macAddresses = {}
+    self.dirty = False
+    self.lastFlush = 0
+
+  def load(self):
+    if not self.path:
+      return
+    try:
+      with open(self.path, 'r') as fh:
+        data = json.load(fh)
+    except FileNotFoundError:
+      logger.info('No VM index found in {0}'.format(self.path))
+      return
+    except (OSError, ValueError) as e:
+      logger.error('Ignoring unreadable VM index {0}: {1}'.format(self.path, e))
+      return
+    with self.lock:
+      self.macAddresses = data
+    logger.info('Loaded {0} VM(s) from index {1}'.format(len(data), self.path))
+
+  def set(self, moId, macAddresses):
+    # Returns the mac addresses the VM doesn't have anymore
+    with self.lock:
+      previous = self.macAddresses.get(moId, [])
+      if previous == macAddresses:
+        return []
+      self.macAddresses[moId] = list(macAddresses)
+      self.dirty = True
+    return [macAddress for macAddress in previous if macAddress not in macAddresses]
+
+  def pop(self, moId):
+    # Mac addresses reused by another VM in the meantime are kept
+    with self.lock:
+      macAddresses = self.macAddresses.pop(moId, [])
+      if not macAddresses:
+        return []
+      self.dirty = True
+      inUse = set(macAddress for others in self.macAddresses.values() for macAddress in others)
+    return [macAddress for macAddress in macAddresses if macAddress not in inUse]
+
+  def extract(self, predicate):
+    # Removes and returns the entries of the VMs matching predicate
+    with self.lock:
+      entries = dict((moId, macAddresses) for moId, macAddresses in self.macAddresses.items() if predicate(moId))
+      for moId in entries:
+        del self.macAddresses[moId]
+      if entries:
+        self.dirty = True
+    return entries
+
+  def merge(self, entries):
+    if not entries:
+      return
+    with self.lock:
+      for moId, macAddresses in entries.items():
+        self.macAddresses.setdefault(moId, macAddresses)
+      self.dirty = True
+
+  def moIds(self):
+    with self.lock:
+      return set(self.macAddresses)
+
+  def __len__(self):
+    with self.lock:
+      return len(self.macAddresses)
+
+  def due(self):
+    return self.dirty and time.time() - self.lastFlush >= self.flushInterval
+
+  def flush(self):
+    if not self.path or not self.dirty:
+      return
+    with self.lock:
+      data = json.dumps(self.macAddresses, separators=(',', ':')).encode('utf8')
+      self.dirty = False
+    atomicWrite(self.path, data)
+    self.lastFlush = time.time()
@@ -6,19 +6,34 @@
 # https://opensource.org/licenses/MIT
 
 import atexit
+import collections
+import contextlib
+import hashlib
 import logging
 import os
 import pypureomapi
+import queue
 import re
+import socket
 import ssl
 import struct
-import sys
+import threading
 import time
+import zlib
 from pyVim.connect import SmartConnect, Disconnect
-from pyVmomi import vim # See https://github.com/vmware/pyvmomi pylint: disable=no-name-in-module
+from pyVmomi import vim, vmodl # See https://github.com/vmware/pyvmomi pylint: disable=no-name-in-module
+from .capture import CaptureWriter, readCapture
+from .checkpoint import FileCheckpointStore
+from .inventory import retrieveAllVmIds, retrieveAllVmSnapshots, retrieveVmSnapshots
+from .profiler import startProfilingHttpServer
+from .rules import RuleEngine
+from .scheduler import AdaptiveScheduler
+from .sharding import createShardManager
+from .tracing import EventTracer
+from .vmindex import VmIndex
 from datetime import datetime, timedelta
 from pytz import timezone
-from prometheus_client import start_http_server, Counter, Gauge, Summary, Info
+from prometheus_client import start_http_server, Counter, Gauge, Histogram, Info
 
 # time (in seconds) between Vmware event checks
 SLEEP_TIME = 5
@@ -27,8 +42,25 @@ SLEEP_TIME = 5
 VMWARE_MONITORED_ADD_EVENTS = [vim.event.VmCreatedEvent]
 VMWARE_MONITORED_UPDATE_EVENTS = [vim.event.VmReconfiguredEvent, vim.event.VmMacChangedEvent, vim.event.VmRenamedEvent, vim.event.VmStartingEvent, vim.event.VmPoweredOnEvent]
 VMWARE_MONITORED_REMOVE_EVENTS = [vim.event.VmRemovedEvent]
-VMWARE_MONITORED_EVENTS = VMWARE_MONITORED_ADD_EVENTS + VMWARE_MONITORED_UPDATE_EVENTS + VMWARE_MONITORED_REMOVE_EVENTS
+VMWARE_MONITORED_CUSTOMFIELD_EVENTS = [vim.event.CustomFieldDefAddedEvent, vim.event.CustomFieldDefRemovedEvent, vim.event.CustomFieldDefRenamedEvent]
+VMWARE_MONITORED_EVENTS = VMWARE_MONITORED_ADD_EVENTS + VMWARE_MONITORED_UPDATE_EVENTS + VMWARE_MONITORED_REMOVE_EVENTS + VMWARE_MONITORED_CUSTOMFIELD_EVENTS
 VMWARE_EVENTS_PAGE_SIZE = 1000
+# number of recently seen event keys remembered to drop events read twice
+VMWARE_EVENTS_DEDUP_SIZE = 10000
+# Event source mode: 'poll' reads the long-lived collector as often as the scheduler decides, 'wait' wakes up as soon as vCenter publishes new events
+VMWARE_EVENTS_MODES = ['poll', 'wait']
+
+# OMAPI sessions idle for longer than this (in seconds) are checked before being reused
+DHCPD_HEALTHCHECK_INTERVAL = 60
+# bounds (in seconds) of the exponential backoff between two DHCP server connection attempts
+DHCPD_RECONNECT_MIN_BACKOFF = 1
+DHCPD_RECONNECT_MAX_BACKOFF = 60
+# number of times a host registration is retried after the OMAPI session broke
+DHCPD_MAX_RETRIES = 3
+# maximum number of VMs waiting in each registration worker queue before the event loop blocks
+WORKER_QUEUE_SIZE = 1000
+# Host objects created by vmware2dhcp are named after their MAC address and a fingerprint of their statements
+DHCPD_HOST_NAME_PREFIX = 'v2d-'
 
 # See https://pubs.vmware.com/vsphere-6-5/topic/com.vmware.vspsdk.apiref.doc/vim.vm.GuestOsDescriptor.GuestOsIdentifier.html
 UNMANAGED_GUESTID_REGEXP = r'^win.+'
@@ -36,266 +68,1268 @@ UNMANAGED_GUESTID_REGEXP = r'^win.+'
 # Sample validating and catching regexp for virtual machine FQDN based name
 FQDN_VALIDATION_REGEXP = re.compile('^([a-zA-Z0-9][a-zA-Z0-9-]*)[.]([a-zA-Z0-9-.]+)')
 
+# Outcomes of filterEvent, 'accepted' being the only one leading to a registration
+FILTER_RESULTS = ['no_vm', 'no_vmconfig', 'bad_network', 'bad_folder', 'bad_resource_pool', 'bad_attribute', 'no_device', 'no_network_interface', 'unsupported_os', 'bad_name', 'other_shard', 'accepted']
+VSPHERE_STAGES = ['connect', 'create_collector', 'read_next_events', 'wait_for_updates', 'retrieve_properties', 'custom_fields', 'retrieve_inventory', 'retrieve_vm_ids']
+DHCPD_STAGES = ['connect', 'healthcheck', 'lookup_host', 'del_host', 'add_host']
+DHCPD_WRITE_ACTIONS = ['unchanged', 'replace', 'create', 'delete', 'dry_run']
+
+# Histogram buckets (in seconds)
+FILTER_LATENCY_BUCKETS = (.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01)
+DHCPD_LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+VSPHERE_LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+EVENT_TO_DHCPD_BUCKETS = (.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
 FILTER_EVENT_COUNT   = Counter('vmware2dhcp_filtering_event_total', 'VM filtering events', ['vc', 'dhcp', 'event'])
-FILTER_EVENT_LATENCY = Summary('vmware2dhcp_filtering_events_latency_seconds', 'VM filtering latency', ['vc', 'dhcp', 'filter'])
-DHCPD_LATENCY        = Summary('vmware2dhcp_dhcpd_latency_seconds', 'dhcpd server latency', ['vc', 'dhcp', 'stage'])
-VSPHERE_LATENCY      = Summary('vmware2dhcp_vsphere_latency_seconds', 'VSphere server latency', ['vc', 'dhcp', 'stage'])
+FILTER_EVENT_LATENCY = Histogram('vmware2dhcp_filtering_events_latency_seconds', 'VM filtering latency', ['vc', 'dhcp'], buckets=FILTER_LATENCY_BUCKETS)
+DHCPD_LATENCY        = Histogram('vmware2dhcp_dhcpd_latency_seconds', 'dhcpd server latency', ['vc', 'dhcp', 'stage'], buckets=DHCPD_LATENCY_BUCKETS)
+VSPHERE_LATENCY      = Histogram('vmware2dhcp_vsphere_latency_seconds', 'VSphere server latency', ['vc', 'dhcp', 'stage'], buckets=VSPHERE_LATENCY_BUCKETS)
+EVENT_TO_DHCPD_LAG   = Histogram('vmware2dhcp_event_to_dhcpd_seconds', 'Time between a VM event creation in VSphere and the resulting dhcpd commit', ['vc', 'dhcp'], buckets=EVENT_TO_DHCPD_BUCKETS)
+EVENT_BACKLOG        = Gauge('vmware2dhcp_event_backlog', 'VM events read from VSphere and not processed yet', ['vc', 'dhcp'])
 VMWARE_EVENT_COUNT   = Counter('vmware2dhcp_vmware_event_total', 'VM events received', ['vc', 'dhcp', 'event'])
 FAILURE_COUNT        = Counter('vmware2dhcp_exception', 'Vmware2dhcp exceptions raised', ['vc', 'dhcp', 'exception'])
+SERVICE_INFO         = Info('vmware2dhcp_info', 'A metric with a constant \'1\' value labeled by several service info', ['vc', 'dhcp'])
+CUSTOMFIELD_CACHE_COUNT = Counter('vmware2dhcp_customfield_cache_total', 'Custom attribute catalogue cache lookups', ['vc', 'dhcp', 'result'])
+COALESCED_EVENT_COUNT = Counter('vmware2dhcp_coalesced_event_total', 'VM events merged into a later event of the same VM', ['vc', 'dhcp'])
+DHCPD_WRITE_COUNT    = Counter('vmware2dhcp_dhcpd_write_total', 'Host registrations by resulting dhcpd operation', ['vc', 'dhcp', 'action'])
+WORKER_QUEUE_DEPTH   = Gauge('vmware2dhcp_worker_queue_depth', 'VMs waiting for a registration worker', ['vc', 'dhcp'])
+WORKER_INFLIGHT      = Gauge('vmware2dhcp_worker_inflight', 'VMs being registered by a worker', ['vc', 'dhcp'])
+RECONCILE_DURATION   = Gauge('vmware2dhcp_reconcile_duration_seconds', 'Duration of the last inventory reconciliation', ['vc', 'dhcp'])
+RECONCILE_LAST_SUCCESS = Gauge('vmware2dhcp_reconcile_last_success_timestamp_seconds', 'Time of the last successful inventory reconciliation', ['vc', 'dhcp'])
+RECONCILE_VM_COUNT   = Counter('vmware2dhcp_reconcile_vm_total', 'VMs checked by inventory reconciliations', ['vc', 'dhcp'])
+EVENT_LAG            = Gauge('vmware2dhcp_event_lag_seconds', 'Age of the last processed event', ['vc', 'dhcp'])
+POLL_INTERVAL        = Gauge('vmware2dhcp_poll_interval_seconds', 'Current time between two event reads when no event is pending', ['vc', 'dhcp'])
+POLL_IDLE_COUNT      = Gauge('vmware2dhcp_poll_idle_reads', 'Consecutive event reads that returned nothing', ['vc', 'dhcp'])
+EVENT_PAGE_SIZE      = Gauge('vmware2dhcp_event_page_size', 'Current maximum number of events asked for in a single read', ['vc', 'dhcp'])
+VSPHERE_OVERLOADED   = Gauge('vmware2dhcp_vsphere_overloaded', 'Whether VSphere server calls are slower than vc_slow_latency, reads being slowed down', ['vc', 'dhcp'])
+SHARDS_OWNED         = Gauge('vmware2dhcp_shards_owned', 'Shards of the VMware inventory leased by this replica', ['vc', 'dhcp'])
+SHARD_MEMBERS        = Gauge('vmware2dhcp_shard_members', 'Live replicas sharing the VMware inventory', ['vc', 'dhcp'])
+SHARD_HANDOVER_COUNT = Counter('vmware2dhcp_shard_handover_total', 'Shards acquired or released by this replica', ['vc', 'dhcp', 'direction'])
+VM_INDEX_SIZE        = Gauge('vmware2dhcp_vm_index_entries', 'VMs whose mac addresses are indexed for removal', ['vc', 'dhcp'])
+CATCHUP_IN_PROGRESS  = Gauge('vmware2dhcp_catchup_in_progress', 'Whether events missed since the last checkpoint are being caught up', ['vc', 'dhcp'])
+CATCHUP_EVENT_COUNT  = Counter('vmware2dhcp_catchup_event_total', 'Events read while catching up from the last checkpoint', ['vc', 'dhcp'])
+DHCPD_POOL_SIZE      = Gauge('vmware2dhcp_dhcpd_pool_connections', 'Open OMAPI sessions', ['vc', 'dhcp', 'state'])
+DHCPD_RECONNECT_COUNT = Counter('vmware2dhcp_dhcpd_reconnect_total', 'OMAPI session (re)connection attempts', ['vc', 'dhcp', 'result'])
 
 logger = logging.getLogger(__name__)
 
 with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'VERSION'), 'r') as fh:
   __version__ = fh.readline().strip()
 
+_exporterLock = threading.Lock()
+_exporterStarted = False
+
+
+def startExporter(cfg):
+  # Several event loops may run in the same process: only the first one starts the Prometheus client
+  global _exporterStarted
+  with _exporterLock:
+    if _exporterStarted or not cfg['prom_enabled']:
+      return
+    if cfg.get('prom_profiling_enabled', False):
+      startProfilingHttpServer( int(cfg['prom_port']) )
+    else:
+      start_http_server( int(cfg['prom_port']) )
+    _exporterStarted = True
+
 
 class MyOmapi(pypureomapi.Omapi):
   def __init__(self, hostname, port, username=None, key=None, timeout=None):
     super(MyOmapi, self).__init__(hostname, port, username.encode('utf8'), key.encode('utf8'), timeout)
 
-  def add_host_with_options(self, mac, options={}, group=None):
+  @staticmethod
+  def build_statements(options):
     optionList=[]
+    for key, value in options.items():
+      optionList.append('option {0} "{1}";'.format(key,value))
+    return ''.join(optionList).lower().encode('utf8')
+
+  @staticmethod
+  def host_lookup_message(mac):
+    msg = pypureomapi.OmapiMessage.open(b'host')
+    msg.obj.append((b'hardware-type', struct.pack('!I', 1)))
+    msg.obj.append((b'hardware-address', pypureomapi.pack_mac(mac)))
+    return msg
+
+  @staticmethod
+  def host_create_message(mac, statements, name=None):
     msg = pypureomapi.OmapiMessage.open(b'host')
     msg.message.append((b'create', struct.pack('!I', 1)))
     msg.message.append((b'exclusive', struct.pack('!I', 1)))
     msg.obj.append((b'hardware-type', struct.pack('!I', 1)))
     msg.obj.append((b'hardware-address', pypureomapi.pack_mac(mac)))
+    if name:
+      msg.obj.append((b'name', name.encode('utf8')))
+    if statements:
+      msg.obj.append((b'statements', statements))
+    return msg
 
-    for key, value in options.items():
-      optionList.append('option {0} "{1}";'.format(key,value))
-    if optionList:
-      msg.obj.append((b'statements', ''.join(optionList).lower().encode('utf8')))
+  def add_host_with_options(self, mac, options={}, group=None, name=None):
+    msg = self.host_create_message(mac, self.build_statements(options), name)
 
     # unsupported since group takes precedence over options
     # if group:
     #   msg.obj.append((b'group', group.encode('utf8')))
 
-    logger.debug('Omapi message: {0}'.format(msg.obj))
+    logger.debug('Omapi message: %s', msg.obj)
 
     response = self.query_server(msg)
     if response.opcode !=  pypureomapi.OMAPI_OP_UPDATE:
       raise pypureomapi.OmapiError('Add failed')
 
+  def query_pipelined(self, messages):
+    # Write all the messages at once, then match the responses to their request by transaction id.
+    # Returns one response per message, in the same order: callers check each opcode on their own
+    self.check_connected()
+    authenticator = self.protocol.authenticators[self.protocol.defauth]
+    pending = {}
+    data = []
+    for idx, msg in enumerate(messages):
+      msg.sign(authenticator)
+      pending[msg.tid] = idx
+      data.append(msg.as_string())
+    self.transport.write(b''.join(data))
 
-class Vmware2dhcp():
+    responses = [None] * len(messages)
+    while pending:
+      response = self.receive_message()
+      if response.rid not in pending:
+        raise pypureomapi.OmapiError('received message is not the response of any pending request')
+      if response.authid != self.protocol.defauth:
+        raise pypureomapi.OmapiError('received message is signed with wrong authenticator')
+      responses[pending.pop(response.rid)] = response
+    return responses
+
+  def ping(self):
+    # Any answer, even an error status, proves the session is still usable
+    self.query_server(pypureomapi.OmapiMessage.open(b'host'))
+
+  def is_connected(self):
+    try:
+      self.check_connected()
+    except pypureomapi.OmapiError:
+      return False
+    return True
+
+
+class OmapiPool():
+  def __init__(self, cfg, size=1):
+    self.cfg = cfg
+    self.size = max(1, size)
+    self.idle = queue.LifoQueue()
+    self.slots = threading.BoundedSemaphore(self.size)
+    self.backoff = 0
+    self.closed = False
+    self.labels = {'vc': cfg['vc_address'], 'dhcp': cfg['dhcp_address']}
+    self.idleGauge = DHCPD_POOL_SIZE.labels(state='idle', **self.labels)
+    self.busyGauge = DHCPD_POOL_SIZE.labels(state='busy', **self.labels)
+    self.latency = dict((stage, DHCPD_LATENCY.labels(stage=stage, **self.labels)) for stage in ['connect', 'healthcheck'])
+
+  def _connect(self):
+    while True:
+      if self.closed:
+        raise pypureomapi.OmapiError('pool closed')
+      logger.info('Connecting to DHCP server: {0}'.format(self.cfg['dhcp_address']))
+      try:
+        with self.latency['connect'].time():
+          # Sessions are long-lived: a DHCP server that stops answering must not hang their users forever
+          conn = MyOmapi(self.cfg['dhcp_address'], int(self.cfg['dhcp_port']), self.cfg['dhcp_key_name'], self.cfg['dhcp_key_value'], float(self.cfg.get('dhcp_timeout', 10)) or None)
+      except (socket.error, pypureomapi.OmapiError) as e:
+        DHCPD_RECONNECT_COUNT.labels(result='failure', **self.labels).inc()
+        self.backoff = min(max(self.backoff * 2, DHCPD_RECONNECT_MIN_BACKOFF), DHCPD_RECONNECT_MAX_BACKOFF)
+        logger.error('Unable to connect to DHCP server: {0}. Retrying in {1}s'.format(e, self.backoff))
+        time.sleep(self.backoff)
+        continue
+      DHCPD_RECONNECT_COUNT.labels(result='success', **self.labels).inc()
+      self.backoff = 0
+      logger.info('Connected to DHCP server!')
+      return conn
+
+  def _acquire(self):
+    self.slots.acquire()
+    try:
+      while True:
+        try:
+          conn, lastUsed = self.idle.get_nowait()
+        except queue.Empty:
+          return self._connect()
+        self.idleGauge.dec()
+        if conn.is_connected() and time.time() - lastUsed < DHCPD_HEALTHCHECK_INTERVAL:
+          return conn
+        try:
+          with self.latency['healthcheck'].time():
+            conn.ping()
+          return conn
+        except (socket.error, pypureomapi.OmapiError) as e:
+          logger.warning('Dropping stale DHCP server session: {0}'.format(e))
+          self._discard(conn)
+    except:
+      self.slots.release()
+      raise
+
+  def _release(self, conn, broken=False):
+    if not broken and conn.is_connected() and not self.closed:
+      self.idle.put((conn, time.time()))
+      self.idleGauge.inc()
+    else:
+      self._discard(conn)
+    self.slots.release()
+
+  def _discard(self, conn):
+    try:
+      conn.close()
+    except Exception as e:
+      logger.debug('Error occured while closing DHCP server session: {0}'.format(e))
+
+  @contextlib.contextmanager
+  def connection(self):
+    conn = self._acquire()
+    self.busyGauge.inc()
+    broken = False
+    try:
+      yield conn
+    except:
+      # The session may still hold unread responses: never hand it out again
+      broken = True
+      raise
+    finally:
+      self.busyGauge.dec()
+      self._release(conn, broken)
+
+  def close(self):
+    logger.info('Disconnecting from DHCP server: {0}'.format(self.cfg['dhcp_address']))
+    self.closed = True
+    while True:
+      try:
+        conn, lastUsed = self.idle.get_nowait()
+      except queue.Empty:
+        break
+      self.idleGauge.dec()
+      self._discard(conn)
+    logger.info('Disconnected from DHCP server')
+
+
+class DesiredStateStore():
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.fingerprints = {}
+
+  def get(self, mac):
+    with self.lock:
+      return self.fingerprints.get(mac)
+
+  def set(self, mac, fingerprint):
+    with self.lock:
+      self.fingerprints[mac] = fingerprint
+
+  def discard(self, mac):
+    with self.lock:
+      self.fingerprints.pop(mac, None)
+
+  def __len__(self):
+    with self.lock:
+      return len(self.fingerprints)
+
+
+class DhcpTarget():
+  def __init__(self, cfg, pool, store=None):
+    self.cfg = cfg
+    self.pool = pool
+    self.store = store if store is not None else DesiredStateStore()
+    self.labels = {'vc': cfg['vc_address'], 'dhcp': cfg['dhcp_address']}
+    self.latency = dict((stage, DHCPD_LATENCY.labels(stage=stage, **self.labels)) for stage in DHCPD_STAGES)
+    self.writes = dict((action, DHCPD_WRITE_COUNT.labels(action=action, **self.labels)) for action in DHCPD_WRITE_ACTIONS)
+    self.eventLag = EVENT_TO_DHCPD_LAG.labels(**self.labels)
+
+  @staticmethod
+  def fingerprint(statements):
+    return hashlib.sha1(statements).hexdigest()[:16]
+
+  @staticmethod
+  def hostName(macAddress, fingerprint):
+    return '{0}{1}-{2}'.format(DHCPD_HOST_NAME_PREFIX, macAddress.replace(':', '').lower(), fingerprint)
+
+  @staticmethod
+  def hostFingerprint(name):
+    if not name:
+      return None
+    name = name.decode('utf8') if isinstance(name, bytes) else name
+    if not name.startswith(DHCPD_HOST_NAME_PREFIX):
+      return None
+    return name.rsplit('-', 1)[-1]
+
+  def registerHosts(self, macAddresses, dhcpOptions, eventTime=None, verify=False):
+    # verify looks every host up in the DHCP server, whatever the desired state says (eg. the server lost its leases file)
+    statements = MyOmapi.build_statements(dhcpOptions)
+    fingerprint = self.fingerprint(statements)
+
+    pending = []
+    for macAddress in macAddresses:
+      if not verify and self.store.get(macAddress) == fingerprint:
+        self.writes['unchanged'].inc()
+      else:
+        pending.append(macAddress)
+    if not pending:
+      return
+
+    try:
+      written = self.withSession('registring VM', self.registerHostBatch, pending, statements, fingerprint)
+    except (socket.error, pypureomapi.OmapiError):
+      for macAddress in pending:
+        self.store.discard(macAddress)
+      return
+    if written and eventTime is not None:
+      self.eventLag.observe((datetime.now(timezone('UTC')) - eventTime).total_seconds())
+
+  def unregisterHosts(self, macAddresses):
+    if not macAddresses:
+      return
+    # Whatever happens next, the hosts must be registered again if the mac addresses ever show up
+    for macAddress in macAddresses:
+      self.store.discard(macAddress)
+    try:
+      self.withSession('unregistring VM', self.unregisterHostBatch, macAddresses)
+    except (socket.error, pypureomapi.OmapiError):
+      pass
+
+  def withSession(self, action, fn, *args):
+    attempt = 0
+    while True:
+      attempt += 1
+      try:
+        with self.pool.connection() as dhcpServer:
+          return fn(dhcpServer, *args)
+      except (socket.error, pypureomapi.OmapiError) as e:
+        # The OMAPI session broke: the pool has dropped it, retry on a fresh one
+        FAILURE_COUNT.labels(exception=e, **self.labels).inc()
+        if attempt < DHCPD_MAX_RETRIES:
+          logger.warning('DHCP server session lost while {0}, retrying: {1}'.format(action, e))
+          continue
+        logger.error('Error occured while {0} in DHCP server: {1}'.format(action, e))
+        raise
+
+  def registerHostBatch(self, dhcpServer, macAddresses, statements, fingerprint):
+    # Each step sends the requests of every NIC back to back: a VM costs at most 3 round trips, whatever its NIC count
+    logger.debug('Mac addresses: %s', macAddresses)
+    with self.latency['lookup_host'].time():
+      responses = dhcpServer.query_pipelined([MyOmapi.host_lookup_message(macAddress) for macAddress in macAddresses])
+
+    handles = {}
+    toCreate = []
+    for macAddress, response in zip(macAddresses, responses):
+      if response.opcode != pypureomapi.OMAPI_OP_UPDATE or response.handle == 0:
+        toCreate.append(macAddress)
+      elif self.hostFingerprint(dict(response.obj).get(b'name')) == fingerprint:
+        # Already registered by a previous run: only remember it
+        self.store.set(macAddress, fingerprint)
+        self.writes['unchanged'].inc()
+      else:
+        handles[macAddress] = response.handle
+
+    written = 0
+    # Hosts are replaced rather than updated: dhcpd can't rename them, and their name carries the fingerprint of their statements
+    if handles:
+      with self.latency['del_host'].time():
+        responses = dhcpServer.query_pipelined([pypureomapi.OmapiMessage.delete(handle) for handle in handles.values()])
+      for macAddress, response in zip(list(handles), responses):
+        if response.opcode != pypureomapi.OMAPI_OP_STATUS:
+          FAILURE_COUNT.labels(exception='delete failed', **self.labels).inc()
+          logger.error('Error occured while unregistring {0} in DHCP server'.format(macAddress))
+      toCreate.extend(handles)
+
+    if toCreate:
+      with self.latency['add_host'].time():
+        responses = dhcpServer.query_pipelined([MyOmapi.host_create_message(macAddress, statements, self.hostName(macAddress, fingerprint)) for macAddress in toCreate])
+      for macAddress, response in zip(toCreate, responses):
+        if response.opcode == pypureomapi.OMAPI_OP_UPDATE:
+          self.store.set(macAddress, fingerprint)
+          self.writes['replace' if macAddress in handles else 'create'].inc()
+          written += 1
+        else:
+          self.store.discard(macAddress)
+          FAILURE_COUNT.labels(exception='add failed', **self.labels).inc()
+          logger.error('Error occured while registring {0} in DHCP server'.format(macAddress))
+    return written
+
+  def unregisterHostBatch(self, dhcpServer, macAddresses):
+    logger.debug('Mac addresses: %s', macAddresses)
+    with self.latency['lookup_host'].time():
+      responses = dhcpServer.query_pipelined([MyOmapi.host_lookup_message(macAddress) for macAddress in macAddresses])
+
+    handles = {}
+    for macAddress, response in zip(macAddresses, responses):
+      if response.opcode != pypureomapi.OMAPI_OP_UPDATE or response.handle == 0:
+        continue
+      # Never delete a host entry vmware2dhcp didn't create
+      if self.hostFingerprint(dict(response.obj).get(b'name')) is None:
+        logger.info('Keeping host entry of {0}: it was not registered by vmware2dhcp'.format(macAddress))
+        continue
+      handles[macAddress] = response.handle
+    if not handles:
+      return
+
+    with self.latency['del_host'].time():
+      responses = dhcpServer.query_pipelined([pypureomapi.OmapiMessage.delete(handle) for handle in handles.values()])
+    for macAddress, response in zip(list(handles), responses):
+      if response.opcode == pypureomapi.OMAPI_OP_STATUS:
+        self.writes['delete'].inc()
+      else:
+        FAILURE_COUNT.labels(exception='delete failed', **self.labels).inc()
+        logger.error('Error occured while unregistring {0} in DHCP server'.format(macAddress))
+
+
+class DryRunTarget():
+  # Stands in for a DHCP server when replaying a capture: registrations are only logged
   def __init__(self, cfg):
-    self.cfg=cfg
+    self.cfg = cfg
+    self.labels = {'vc': cfg['vc_address'], 'dhcp': cfg['dhcp_address']}
+    self.writes = DHCPD_WRITE_COUNT.labels(action='dry_run', **self.labels)
 
+  def registerHosts(self, macAddresses, dhcpOptions, eventTime=None, verify=False):
+    statements = MyOmapi.build_statements(dhcpOptions)
+    for macAddress in macAddresses:
+      self.writes.inc()
+      logger.info('Dry run: would register {0} as {1}'.format(macAddress, DhcpTarget.hostName(macAddress, DhcpTarget.fingerprint(statements))))
 
-  def createTimeFilter(self,vStartTime, vEndTime):
-      localTimeFilter = vim.event.EventFilterSpec.ByTime()
-      localTimeFilter.beginTime = vStartTime
-      localTimeFilter.endTime = vEndTime
-      return localTimeFilter
+  def unregisterHosts(self, macAddresses):
+    for macAddress in macAddresses:
+      self.writes.inc()
+      logger.info('Dry run: would unregister {0}'.format(macAddress))
 
-  def filterEvent(self,event):
 
-    with FILTER_EVENT_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], filter='check_vm').time():
-      # Filter out event if we don't have any associated VM
-      if event.vm is None:
-        FILTER_EVENT_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], event='no_vm').inc()
-        return False
+class CustomFieldCache():
+  def __init__(self, si, cfg, ttl=300, slots=None):
+    self.si = si
+    self.cfg = cfg
+    self.ttl = ttl
+    self.slots = slots if slots is not None else threading.BoundedSemaphore(1)
+    self.namespace = cfg['vc_customattribute_dhcpoption_namespace']
+    self.lock = threading.Lock()
+    self.dhcpOptionNames = None
+    self.attributeKeys = None
+    self.expires = 0
+    labels = {'vc': cfg['vc_address'], 'dhcp': cfg['dhcp_address']}
+    self.latency = VSPHERE_LATENCY.labels(stage='custom_fields', **labels)
+    self.lookups = dict((result, CUSTOMFIELD_CACHE_COUNT.labels(result=result, **labels)) for result in ['hit', 'miss', 'refresh'])
 
-    with FILTER_EVENT_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], filter='check_vmconfig').time():
-      # Filter out event if we don't have access to the VM hardware configuration
-      if event.vm.vm.config is None:
-        FILTER_EVENT_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], event='no_vmconfig').inc()
-        return False
+  def invalidate(self):
+    with self.lock:
+      self.dhcpOptionNames = None
 
-    with FILTER_EVENT_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], filter='check_network').time():
-      # Filter out event if the VM doesn't live on a provisioning subnet
-      if self.cfg['vm_networks']:
-        inMonitoredVmNetwork = False
-        for network in event.vm.vm.network:
-          if network.name in self.cfg['vm_networks']:
-            inMonitoredVmNetwork = True
-            break
-        if not inMonitoredVmNetwork:
-          FILTER_EVENT_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], event='bad_network').inc()
-          return False
-
-    with FILTER_EVENT_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], filter='check_device').time():
-      # Filter out event if the VM doesn't have any attached device
-      if event.vm.vm.config.hardware.device is None:
-        FILTER_EVENT_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], event='no_device').inc()
-        return
-
-    with FILTER_EVENT_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], filter='check_network_interface').time():
-      # Filter out event if the VM doesn't have any network interface
-      hasEthernetCard = False
-      for dev in event.vm.vm.config.hardware.device:
-        if isinstance(dev, vim.vm.device.VirtualEthernetCard):
-          hasEthernetCard = True
-          break
-      if not hasEthernetCard:
-        FILTER_EVENT_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], event='no_network_interface').inc()
-        return False
+  def refresh(self):
+    dhcpOptionNames = {}
+    attributeKeys = {}
+    with self.slots, self.latency.time():
+      fields = self.si.content.customFieldsManager.field
+    for field in fields:
+      if field.managedObjectType in (None, vim.VirtualMachine):
+        attributeKeys[field.name] = field.key
+      if field.managedObjectType == vim.VirtualMachine and field.name.startswith(self.namespace):
+        dhcpOptionNames[field.key] = field.name[len(self.namespace):]
+    logger.debug('List of custom attributes that will be pushed as dhcp option: {0}'.format(dhcpOptionNames))
+    return dhcpOptionNames, attributeKeys
 
-    with FILTER_EVENT_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], filter='check_os').time():
-      # Filter out if the registered guest OS is not managed by our DHCP
-      if re.match(UNMANAGED_GUESTID_REGEXP, event.vm.vm.config.guestId, re.IGNORECASE):
-        FILTER_EVENT_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], event='unsupported_os').inc()
-        return False
+  def load(self):
+    with self.lock:
+      if self.dhcpOptionNames is not None and time.time() < self.expires:
+        self.lookups['hit'].inc()
+        return self.dhcpOptionNames, self.attributeKeys
+      self.lookups['miss' if self.dhcpOptionNames is None else 'refresh'].inc()
+      self.dhcpOptionNames, self.attributeKeys = self.refresh()
+      self.expires = time.time() + self.ttl
+      return self.dhcpOptionNames, self.attributeKeys
 
-    with FILTER_EVENT_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], filter='check_name').time():
-      # Filter out badly formatted VM name
-      if not FQDN_VALIDATION_REGEXP.match(event.vm.vm.config.name):
-        FILTER_EVENT_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], event='bad_name').inc()
-        return False
+  def get(self):
+    return self.load()[0]
 
-    # we have a winner!
-    FILTER_EVENT_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], event='accepted').inc()
-    return True
+  def keys(self):
+    # Keys of all the VM custom attributes, by name
+    return self.load()[1]
+
+
+class StaticCustomFieldCache():
+  # Custom attribute catalogue of a replayed capture
+  def __init__(self, dhcpOptionNames=None, attributeKeys=None):
+    self.dhcpOptionNames = dhcpOptionNames or {}
+    self.attributeKeys = attributeKeys or {}
+
+  def invalidate(self):
+    pass
+
+  def get(self):
+    return self.dhcpOptionNames
 
-  def dhcpConnect(self):
-    global dhcpServer
-    logger.info('Connecting to DHCP server: {0}'.format(self.cfg['dhcp_address']))
+  def keys(self):
+    return self.attributeKeys
+
+
+class ShardedWorkerPool():
+  def __init__(self, cfg, workers):
+    self.cfg = cfg
+    self.queues = []
+    self.queueDepth = WORKER_QUEUE_DEPTH.labels(vc=cfg['vc_address'], dhcp=cfg['dhcp_address'])
+    self.inflight = WORKER_INFLIGHT.labels(vc=cfg['vc_address'], dhcp=cfg['dhcp_address'])
+    for idx in range(workers):
+      tasks = queue.Queue(WORKER_QUEUE_SIZE)
+      self.queues.append(tasks)
+      threading.Thread(target=self.run, args=(tasks,), name='worker-{0}'.format(idx), daemon=True).start()
+
+  def submit(self, key, fn, *args):
+    # Tasks sharing a key always land on the same worker, hence run in submission order
+    if not self.queues:
+      self.execute(fn, args)
+      return
+    self.queueDepth.inc()
+    self.queues[zlib.crc32(key.encode('utf8')) % len(self.queues)].put((fn, args))
+
+  def execute(self, fn, args):
+    self.inflight.inc()
     try:
-      dhcpServer = MyOmapi(self.cfg['dhcp_address'], self.cfg['dhcp_port'], self.cfg['dhcp_key_name'], self.cfg['dhcp_key_value'])
+      fn(*args)
     except Exception as e:
-      logger.critical('Unable to connect to DHCP server: {0}'.format(e))
-      sys.exit(-1)
-    logger.info('Connected to DHCP server!')
+      FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
+      logger.exception('Error occured while processing VM: {0}'.format(e))
+    finally:
+      self.inflight.dec()
 
-  def dhcpDisconnect(self):
-    global dhcpServer
-    logger.info('Disconnecting from DHCP server: {0}'.format(self.cfg['dhcp_address']))
+  def run(self, tasks):
+    while True:
+      task = tasks.get()
+      if task is None:
+        tasks.task_done()
+        break
+      self.queueDepth.dec()
+      self.execute(*task)
+      tasks.task_done()
+
+  def join(self):
+    for tasks in self.queues:
+      tasks.join()
+
+  def close(self):
+    for tasks in self.queues:
+      tasks.put(None)
+
+
+class EventStream():
+  def __init__(self, si, cfg, beginTime, mode='poll', resumeKey=None, resumeTime=None):
+    if mode not in VMWARE_EVENTS_MODES:
+      raise ValueError('Unsupported event mode {0} (choose from {1})'.format(mode, VMWARE_EVENTS_MODES))
+    self.si = si
+    self.cfg = cfg
+    self.mode = mode
+    self.lastEventTime = beginTime
+    self.resumeKey = resumeKey
+    self.resumeTime = resumeTime
+    self.seenKeys = collections.OrderedDict()
+    self.collector = None
+    self.waitCollector = None
+    self.waitVersion = ''
+    self.latency = dict((stage, VSPHERE_LATENCY.labels(vc=cfg['vc_address'], dhcp=cfg['dhcp_address'], stage=stage)) for stage in ['create_collector', 'read_next_events', 'wait_for_updates'])
+
+  def createTimeFilter(self, vStartTime, vEndTime=None):
+    localTimeFilter = vim.event.EventFilterSpec.ByTime()
+    localTimeFilter.beginTime = vStartTime
+    localTimeFilter.endTime = vEndTime
+    return localTimeFilter
+
+  def open(self):
+    # No end time: the collector keeps growing as new events get published
+    efs = vim.event.EventFilterSpec(eventTypeId=list(map(lambda x: x.__name__,VMWARE_MONITORED_EVENTS)))
+    efs.time = self.createTimeFilter(self.lastEventTime)
+    logger.info('Creating event collector from {0}'.format(self.lastEventTime))
+    with self.latency['create_collector'].time():
+      self.collector = self.si.content.eventManager.CreateCollectorForEvents(efs)
+      # latestPage is only watched as a wake-up signal in 'wait' mode: keep its updates tiny
+      self.collector.SetCollectorPageSize(1 if self.mode == 'wait' else VMWARE_EVENTS_PAGE_SIZE)
+    if self.mode == 'wait':
+      self.waitCollector = self.si.content.propertyCollector.CreatePropertyCollector()
+      self.waitCollector.CreateFilter(vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=self.collector, skip=False)],
+        propSet=[vmodl.query.PropertyCollector.PropertySpec(type=vim.event.EventHistoryCollector, pathSet=['latestPage'])]
+      ), False)
+      self.waitVersion = ''
+
+  def close(self):
+    for collector, destroy in [(self.waitCollector, 'DestroyPropertyCollector'), (self.collector, 'DestroyCollector')]:
+      if collector is None:
+        continue
+      try:
+        getattr(collector, destroy)()
+      except Exception as e:
+        logger.debug('Error occured while destroying collector: {0}'.format(e))
+    self.collector = None
+    self.waitCollector = None
+
+  def isNew(self, event):
+    # Event keys only grow: anything up to the checkpointed event has already been processed.
+    # Later events are new whatever their key, should it have started over (eg. a restored vCenter)
+    if self.resumeKey is not None and event.createdTime <= self.resumeTime and event.key <= self.resumeKey:
+      return False
+    if event.key in self.seenKeys:
+      return False
+    self.seenKeys[event.key] = True
+    if len(self.seenKeys) > VMWARE_EVENTS_DEDUP_SIZE:
+      self.seenKeys.popitem(last=False)
+    return True
+
+  def readNextPage(self, maxCount=VMWARE_EVENTS_PAGE_SIZE):
+    if self.collector is None:
+      self.open()
+    while True:
+      try:
+        with self.latency['read_next_events'].time():
+          events = self.collector.ReadNextEvents(maxCount)
+      except Exception:
+        # Collector (or session) is gone: it will be recreated from the last event time, duplicates being dropped by key
+        self.close()
+        raise
+      if not events:
+        return []
+      newEvents = [event for event in events if self.isNew(event)]
+      if newEvents:
+        self.lastEventTime = max(self.lastEventTime, max(event.createdTime for event in newEvents))
+        return newEvents
+
+  def wait(self, timeout):
+    if self.mode != 'wait' or self.waitCollector is None:
+      time.sleep(timeout)
+      return
     try:
-      dhcpServer.close()
-    except Exception as e:
-      logger.critical('Error occured during disconnection: {0}'.format(e))
-    logger.info('Disconnected from DHCP server')
+      with self.latency['wait_for_updates'].time():
+        update = self.waitCollector.WaitForUpdatesEx(self.waitVersion, vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max(1, int(timeout))))
+    except Exception:
+      self.close()
+      raise
+    if update is not None:
+      self.waitVersion = update.version
 
 
-  def registerVm(self,vm,cf):
-    global dhcpServer
-    macAddressList = []
-    relevantCustomFields = {}
-    dhcpOptions = {}
+class Vmware2dhcp():
+  def __init__(self, cfg, dhcpTargets=None, workers=None):
+    self.shards = None
+    if int(cfg.get('shard_count', 0)) > 0:
+      self.shards = createShardManager(cfg)
+      # Replicas share their state volume: each one keeps its own files
+      cfg = dict(cfg)
+      for key in ['capture_file', 'checkpoint_file', 'vm_index_file']:
+        if cfg.get(key):
+          cfg[key] = '{0}.{1}'.format(cfg[key], self.shards.member)
+    self.cfg=cfg
+    if dhcpTargets is None:
+      dhcpTargets = [DhcpTarget(cfg, OmapiPool(cfg, int(cfg.get('dhcp_pool_size', 1))))]
+      atexit.register(dhcpTargets[0].pool.close)
+    self.dhcpTargets = dhcpTargets
+    self.vsphereSlots = threading.BoundedSemaphore(max(1, int(cfg.get('vc_max_inflight', 1))))
+    # A supervisor hands the same workers to every run of a source
+    if workers is None:
+      workers = ShardedWorkerPool(cfg, int(cfg.get('workers', 0)))
+      atexit.register(workers.close)
+    self.workers = workers
+    self.stopped = threading.Event()
+    self.si = None
+    self.stream = None
+    self.capture = None
+    # Metric children are resolved once: label lookups are not free on a per-event basis
+    self.labels = {'vc': cfg['vc_address'], 'dhcp': cfg['dhcp_address']}
+    self.filterLatency = FILTER_EVENT_LATENCY.labels(**self.labels)
+    self.filterResults = dict((result, FILTER_EVENT_COUNT.labels(event=result, **self.labels)) for result in FILTER_RESULTS)
+    self.vsphereLatency = dict((stage, VSPHERE_LATENCY.labels(stage=stage, **self.labels)) for stage in VSPHERE_STAGES)
+    self.eventCounts = dict((eventType.__name__, VMWARE_EVENT_COUNT.labels(event=eventType.__name__, **self.labels)) for eventType in VMWARE_MONITORED_EVENTS)
+    self.coalescedEvents = COALESCED_EVENT_COUNT.labels(**self.labels)
+    self.eventLag = EVENT_LAG.labels(**self.labels)
+    self.eventBacklog = EVENT_BACKLOG.labels(**self.labels)
+    self.customFields = None
+    self.vmIndex = VmIndex(cfg.get('vm_index_file') or None, float(cfg.get('checkpoint_flush_interval', 5)))
+    self.vmIndexSize = VM_INDEX_SIZE.labels(**self.labels)
+    self.scheduler = AdaptiveScheduler(float(cfg.get('vc_poll_min_interval', 0.5)), float(cfg.get('vc_poll_max_interval', 30)), float(cfg.get('vc_slow_latency', 2)))
+    self.tracer = EventTracer(float(cfg.get('trace_sample_rate', 0)))
+    self.scheduleMetrics = (POLL_INTERVAL.labels(**self.labels), POLL_IDLE_COUNT.labels(**self.labels), EVENT_PAGE_SIZE.labels(**self.labels), VSPHERE_OVERLOADED.labels(**self.labels))
+    self.rules = RuleEngine(cfg.get('vm_rules') or {}, cfg.get('vm_networks'), FQDN_VALIDATION_REGEXP, UNMANAGED_GUESTID_REGEXP, lambda: self.customFields.keys())
+
+
+  def prefetchVms(self, si, events):
+    vmRefs = []
+    for event in events:
+      if isinstance(event, tuple(VMWARE_MONITORED_ADD_EVENTS + VMWARE_MONITORED_UPDATE_EVENTS)) and event.vm is not None:
+        vmRefs.append(event.vm.vm)
+    if not vmRefs:
+      return {}
+    with self.vsphereSlots:
+      startTime = time.perf_counter()
+      vms = retrieveVmSnapshots(si.content.propertyCollector, vmRefs, self.rules.properties)
+      elapsed = time.perf_counter() - startTime
+    self.vsphereLatency['retrieve_properties'].observe(elapsed)
+    self.scheduler.observeLatency(elapsed)
+    return vms
+
+  def isOwned(self, moId, shards=None):
+    # Whether this replica writes the VM: always true unless sharding is enabled
+    if self.shards is None:
+      return True
+    shard = self.shards.shardOf(moId)
+    return shard in shards if shards is not None else self.shards.owns(shard)
+
+  def rebalanceShards(self):
+    # Returns the shards just acquired
+    toAcquire, toRelease = self.shards.plan()
+    if toRelease:
+      self.releaseShards(toRelease)
+    acquired = self.shards.acquire(toAcquire)
+    for shard in acquired:
+      # VM index entries handed over by the previous owner
+      self.vmIndex.merge(self.shards.takeState(shard))
+    if acquired:
+      logger.info('Acquired shard(s) {0}'.format(acquired))
+      SHARD_HANDOVER_COUNT.labels(direction='acquired', **self.labels).inc(len(acquired))
+    SHARDS_OWNED.labels(**self.labels).set(len(self.shards.ownedShards()))
+    SHARD_MEMBERS.labels(**self.labels).set(len(self.shards.members))
+    return acquired
 
-    logger.debug('List of published custom attributes: {0}'.format(cf))
+  def releaseShards(self, shards):
+    # The next owner must not write before the VMs of these shards are done with
+    self.workers.join()
+    states = {}
+    for moId, macAddresses in self.vmIndex.extract(lambda moId: self.shards.shardOf(moId) in shards).items():
+      states.setdefault(self.shards.shardOf(moId), {})[moId] = macAddresses
+    self.shards.release(shards, states)
+    logger.info('Released shard(s) {0}'.format(sorted(shards)))
+    SHARD_HANDOVER_COUNT.labels(direction='released', **self.labels).inc(len(shards))
 
-    with DHCPD_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], stage='connect').time():
-      self.dhcpConnect()
+  def renewShards(self):
+    while not self.stopped.wait(self.shards.renewInterval):
+      try:
+        self.shards.heartbeat()
+      except Exception as e:
+        FAILURE_COUNT.labels(exception=e, **self.labels).inc()
+        logger.error('Error occured while renewing shard leases: {0}'.format(e))
 
-    for field in cf:
-      if field.managedObjectType == vim.VirtualMachine and field.name.startswith(self.cfg['vc_customattribute_dhcpoption_namespace']):
-        relevantCustomFields[field.key] = re.sub('^%s' % re.escape(self.cfg['vc_customattribute_dhcpoption_namespace']), '', field.name)
+  def filterEvent(self,vm,trace=None):
+    startTime = time.perf_counter()
+    result = self.filterResult(vm)
+    self.filterLatency.observe(time.perf_counter() - startTime)
+    self.filterResults[result].inc()
+    if trace is not None:
+      trace.stage('filter')
+      trace.set('verdict', result)
+    return result == 'accepted'
 
-    logger.debug('List of custom attributes that will be pushed as dhcp option: {0}'.format(relevantCustomFields))
+  def filterResult(self,vm):
+    # Filter out event if we don't have any associated VM
+    if vm is None:
+      return 'no_vm'
+    return self.rules.evaluate(vm)
+
+  def acceptEvent(self, event):
+    # Most events are about VMs we don't manage: reject them on their name before reading anything from vCenter
+    if not isinstance(event, tuple(VMWARE_MONITORED_ADD_EVENTS + VMWARE_MONITORED_UPDATE_EVENTS)):
+      return True
+    name = event.newName if isinstance(event, vim.event.VmRenamedEvent) else event.vm.name
+    if name is None or self.rules.acceptsName(name):
+      return True
+    self.filterResults['bad_name'].inc()
+    return False
+
+  def registerVm(self,vm,eventTime=None,verify=False):
+    relevantCustomFields = self.customFields.get()
+    dhcpOptions = {}
 
     # Split name/domain-name from VM name
-    fqdnMatch = FQDN_VALIDATION_REGEXP.match(vm.config.name)
+    fqdnMatch = FQDN_VALIDATION_REGEXP.match(vm.name)
 
-    # Looking for the VM mac addresses
-    for dev in vm.config.hardware.device:
-      if isinstance(dev, vim.vm.device.VirtualEthernetCard):
-        macAddressList.append(dev.macAddress)
+    for key, value in vm.customValues.items():
+      if key in relevantCustomFields:
+        dhcpOptions[relevantCustomFields[key]]= value
 
-    for field in vm.customValue:
-      if field.key in relevantCustomFields:
-        dhcpOptions[relevantCustomFields[field.key]]= field.value
+    dhcpOptions['host-name'] = fqdnMatch.group(1)
+    dhcpOptions['domain-name'] = fqdnMatch.group(2)
+    logger.debug('DHCP options: %s', dhcpOptions)
 
-    for macAddress in macAddressList:
-      while True:
+    # Mac addresses can't be read anymore once the VM is removed: remember them until then
+    staleMacAddresses = self.vmIndex.set(vm.moId, vm.macAddresses)
+    for dhcpTarget in self.dhcpTargets:
+      dhcpTarget.unregisterHosts(staleMacAddresses)
+      dhcpTarget.registerHosts(vm.macAddresses, dhcpOptions, eventTime, verify)
 
-        try:
-          with DHCPD_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], stage='del_host').time():
-            dhcpServer.del_host(macAddress)
-        except pypureomapi.OmapiErrorNotFound as e:
-          FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
-          pass
-        except Exception as e:
-          FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
-          logger.error('Error occured while unregistring VM in DHCP server: {0}'.format(e))
+  def removeVm(self, moId):
+    macAddresses = self.vmIndex.pop(moId)
+    if not macAddresses:
+      logger.debug('No indexed mac address for removed VM %s', moId)
+      return macAddresses
+    logger.info('Unregistring mac addresses {0} of removed VM {1}'.format(macAddresses, moId))
+    for dhcpTarget in self.dhcpTargets:
+      dhcpTarget.unregisterHosts(macAddresses)
+    return macAddresses
 
-        try:
-          dhcpOptions['host-name'] = fqdnMatch.group(1)
-          dhcpOptions['domain-name'] = fqdnMatch.group(2)
-          logger.debug('DHCP options: {0}'.format(dhcpOptions))
-          logger.debug('Mac address: {0}'.format(macAddress))
-          with DHCPD_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], stage='add_host').time():
-            dhcpServer.add_host_with_options(macAddress, dhcpOptions, self.cfg['dhcp_group'] )
-        except Exception as e:
-          FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
-          logger.error('Error occured while registring VM in DHCP server: {0}'.format(e))
+  def sweepVmIndex(self, si):
+    # The index is read first: VMs registered in the meantime can't be mistaken for removed ones
+    indexedIds = set(moId for moId in self.vmIndex.moIds() if self.isOwned(moId))
+    with self.vsphereSlots, self.vsphereLatency['retrieve_vm_ids'].time():
+      vmIds = retrieveAllVmIds(si.content)
+    self.removeOrphans(indexedIds, vmIds)
 
-        break
+  def removeOrphans(self, indexedIds, vmIds):
+    # Removal events missed while the service was down (or older than the catch-up window)
+    if not vmIds and indexedIds:
+      logger.warning('VSphere server returned no VM at all, not removing the {0} indexed one(s)'.format(len(indexedIds)))
+      return
+    orphans = indexedIds.difference(vmIds)
+    if orphans:
+      logger.info('Removing {0} VM(s) missing from the VSphere inventory'.format(len(orphans)))
+    for moId in orphans:
+      self.workers.submit(moId, self.removeVm, moId)
+    self.workers.join()
 
-    with DHCPD_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], stage='disconnect').time():
-      self.dhcpDisconnect()
+  def reconcile(self, si, shards=None):
+    # shards restricts the reconciliation to some shards of the inventory, when sharding is enabled
+    if shards is None:
+      logger.info('Reconciling DHCP server with the whole VSphere inventory')
+    else:
+      logger.info('Reconciling DHCP server with shard(s) {0} of the VSphere inventory'.format(sorted(shards)))
+    startTime = time.time()
+    indexedIds = set(moId for moId in self.vmIndex.moIds() if self.isOwned(moId, shards))
+    with self.vsphereSlots, self.vsphereLatency['retrieve_inventory'].time():
+      vms = retrieveAllVmSnapshots(si.content, self.rules.properties)
+    logger.info('Retrieved {0} VM(s) in {1:.1f}s'.format(len(vms), time.time() - startTime))
+    for vm in vms.values():
+      if self.isOwned(vm.moId, shards):
+        self.workers.submit(vm.moId, self.reconcileVm, vm)
+    self.workers.join()
+    self.removeOrphans(indexedIds, set(vms))
+    RECONCILE_VM_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address']).inc(len(vms))
+    RECONCILE_DURATION.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address']).set(time.time() - startTime)
+    RECONCILE_LAST_SUCCESS.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address']).set_to_current_time()
+    logger.info('Reconciliation done in {0:.1f}s'.format(time.time() - startTime))
 
-    return
+  def reconcileVm(self, vm):
+    # Reconciliations are there to repair the DHCP server: check it rather than what was last written to it
+    if self.filterEvent(vm):
+      self.registerVm(vm, verify=True)
 
-  def start(self):
+  def connect(self):
     # Disable SSL certificate checking
     context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
     context.verify_mode = ssl.CERT_NONE
 
-    # Start Prometheus client if asked to
-    if self.cfg['prom_enabled']:
-      start_http_server( self.cfg['prom_port'] )
-
-    # set Info metric
-    i = Info('vmware2dhcp_info', 'A metric with a constant \'1\' value labeled by several service info')
-    i.info({'version': __version__, 'vc': self.cfg['vc_address'], 'dhcp': self.cfg['dhcp_address']})
-
     si = None
     # Getting the Service Instance
     logger.info('Connecting to VSphere server: {0}'.format(self.cfg['vc_address']))
     try:
-      with VSPHERE_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], stage='connect').time():
+      with self.vsphereLatency['connect'].time():
         si = SmartConnect(protocol='https',host=self.cfg['vc_address'],port=443,user=self.cfg['vc_username'],pwd=self.cfg['vc_password'],sslContext=context)
     except Exception as e:
       print('Could not connect to the specified vCenter, please check the provided address, username and password: {0}'.format(e))
       raise SystemExit(-1)
     logger.info('Connected to VSphere server!')
+    return si
 
-    #Cleanly disconnect
-    atexit.register(Disconnect, si)
-    em = si.content.eventManager
-    efs = vim.event.EventFilterSpec(eventTypeId=list(map(lambda x: x.__name__,VMWARE_MONITORED_EVENTS)))
-    now = datetime.now(timezone('UTC'))
-    efs.time = self.createTimeFilter(now,now)
-    ehc = em.CreateCollectorForEvents(efs)
-    ehc.SetCollectorPageSize(VMWARE_EVENTS_PAGE_SIZE)
-    lastEventTimeUTC = None
+  def disconnect(self, si):
+    Disconnect(si)
 
-    while True:
-      if lastEventTimeUTC is not None:
-        logger.info('Waiting for event. Last event time: {0}'.format(lastEventTimeUTC))
-        startTime = lastEventTimeUTC + timedelta(seconds=1)
-        endTime = datetime.now(timezone('UTC'))
-        efs.time = self.createTimeFilter(startTime,endTime)
+  def stop(self):
+    # The event loop exits once it is done with the page being processed
+    self.stopped.set()
+
+  def start(self):
+    # Start Prometheus client if asked to
+    startExporter(self.cfg)
+
+    # set Info metric
+    SERVICE_INFO.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address']).info({'version': __version__})
+
+    self.si = self.connect()
+    # Registered for this run only: a supervisor restarts failed runs with new instances
+    atexit.register(self.close)
+    try:
+      return self.eventLoop(self.si)
+    finally:
+      atexit.unregister(self.close)
+      self.close()
+
+  def close(self):
+    # Releases what a run acquired, whether it stopped, failed or the process exits
+    self.stopped.set()
+    if self.stream is not None:
+      self.stream.close()
+      self.stream = None
+    if self.capture is not None:
+      self.capture.close()
+    try:
+      self.vmIndex.flush()
+    except OSError as e:
+      FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
+      logger.error('Error occured while writing VM index: {0}'.format(e))
+    if self.si is not None:
+      self.disconnect(self.si)
+      self.si = None
+
+  def eventLoop(self, si):
+    self.vmIndex.load()
+    self.vmIndexSize.set(len(self.vmIndex))
+    self.customFields = CustomFieldCache(si, self.cfg, int(self.cfg.get('vc_customattribute_cache_ttl', 300)), self.vsphereSlots)
+    # Shards acquired but not reconciled yet: their events may have been missed while nobody owned them
+    unreconciledShards = set()
+    nextRebalance = time.time()
+    if self.shards is not None:
+      logger.info('Sharding the VSphere inventory in {0} shards as member {1}'.format(self.shards.shardCount, self.shards.member))
+      self.shards.heartbeat()
+      threading.Thread(target=self.renewShards, name='shard-leases', daemon=True).start()
+    if self.cfg.get('capture_file'):
+      logger.info('Capturing events into {0}'.format(self.cfg['capture_file']))
+      self.capture = CaptureWriter(self.cfg['capture_file'])
+    beginTime = datetime.now(timezone('UTC'))
+    resumeKey = resumeTime = None
+    self.catchingUp = False
+    self.checkpoint = None
+    if self.cfg.get('checkpoint_file'):
+      self.checkpoint = FileCheckpointStore(self.cfg['checkpoint_file'], float(self.cfg.get('checkpoint_flush_interval', 5)), si.content.about.instanceUuid)
+      resumeKey, resumeTime = self.checkpoint.load()
+      if resumeTime is not None:
+        oldestTime = beginTime - timedelta(seconds=int(self.cfg.get('checkpoint_max_catchup', 3600)))
+        if resumeTime < oldestTime:
+          logger.warning('Last checkpoint at {0} is too old, events older than {1} are skipped'.format(resumeTime, oldestTime))
+        beginTime = max(resumeTime, oldestTime)
+        self.catchingUp = True
+        CATCHUP_IN_PROGRESS.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address']).set(1)
+        logger.info('Catching up events since {0}'.format(beginTime))
+    stream = self.stream = EventStream(si, self.cfg, beginTime, self.cfg.get('vc_event_mode', 'poll'), resumeKey, resumeTime)
+    reconcileInterval = int(self.cfg.get('reconcile_interval', 0))
+    nextReconcile = time.time() if self.cfg.get('reconcile_on_startup', False) else (time.time() + reconcileInterval if reconcileInterval > 0 else None)
+    coalesceWindow = float(self.cfg.get('vc_event_coalesce_window', 0))
+    sweepInterval = int(self.cfg.get('vm_index_sweep_interval', 3600))
+    nextSweep = time.time() + sweepInterval if sweepInterval > 0 else None
+    # Page whose processing failed, read again from memory: the event collector is already past it
+    retryEvents = None
+
+    while not self.stopped.is_set():
+      if self.shards is not None and time.time() >= nextRebalance:
+        try:
+          unreconciledShards.update(self.rebalanceShards())
+        except Exception as e:
+          FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
+          logger.error('Error occured while rebalancing shards: {0}'.format(e))
+        nextRebalance = time.time() + self.shards.renewInterval
+        unreconciledShards.intersection_update(self.shards.ownedShards())
+        if unreconciledShards and not (nextReconcile is not None and time.time() >= nextReconcile):
+          try:
+            self.reconcile(si, set(unreconciledShards))
+            unreconciledShards.clear()
+          except Exception as e:
+            FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
+            logger.error('Error occured while reconciling acquired shards: {0}'.format(e))
+
+      if nextReconcile is not None and time.time() >= nextReconcile:
+        try:
+          self.reconcile(si)
+          unreconciledShards.clear()
+        except Exception as e:
+          FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
+          logger.error('Error occured while reconciling inventory: {0}'.format(e))
+        nextReconcile = time.time() + reconcileInterval if reconcileInterval > 0 else None
+        # A reconciliation sweeps the index as well
+        nextSweep = time.time() + sweepInterval if sweepInterval > 0 else None
+
+      if nextSweep is not None and time.time() >= nextSweep:
         try:
-          ehc.DestroyCollector()
-          ehc = em.CreateCollectorForEvents(efs)
-        except:
-          lastEventTimeUTC = lastEventTimeUTC + timedelta(seconds=1)
+          self.sweepVmIndex(si)
+        except Exception as e:
+          FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
+          logger.error('Error occured while sweeping VM index: {0}'.format(e))
+        nextSweep = time.time() + sweepInterval
+
+      retrying = retryEvents is not None
+      if retrying:
+        events, retryEvents = retryEvents, None
       else:
-        lastEventTimeUTC = now
-      with VSPHERE_LATENCY.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], stage='read_next_events').time():
-        events = ehc.ReadNextEvents(VMWARE_EVENTS_PAGE_SIZE)
-
-      while len(events) > 0:
-        logger.debug('Received {0} event(s)'.format(len(events)))
-        for idx, event in enumerate(events):
-          logger.debug('Event #{0} at {1}: {2}'.format(idx, event.createdTime, event.fullFormattedMessage))
-          logger.debug('Event data: {0}'.format(event))
-
-          VMWARE_EVENT_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], event=event.__class__.__name__).inc()
-
-          if isinstance(event, tuple(VMWARE_MONITORED_ADD_EVENTS)):
-            if self.filterEvent(event):
-              self.registerVm(event.vm.vm, si.content.customFieldsManager.field)
-          elif isinstance(event, tuple(VMWARE_MONITORED_UPDATE_EVENTS)):
-            if self.filterEvent(event):
-              self.registerVm(event.vm.vm, si.content.customFieldsManager.field)
-          elif isinstance(event, tuple(VMWARE_MONITORED_REMOVE_EVENTS)):
-            # not implemented. Virtual Machine object properties are lost when this event pops up
-            pass
-          lastEventTimeUTC = event.createdTime
-        events = ehc.ReadNextEvents(VMWARE_EVENTS_PAGE_SIZE)
+        events = self.readEvents(stream)
+      if events is None:
+        self.stopped.wait(SLEEP_TIME)
+        continue
+
+      if not events:
+        if self.catchingUp:
+          logger.info('Caught up with events missed since the last checkpoint')
+          self.catchingUp = False
+          CATCHUP_IN_PROGRESS.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address']).set(0)
+        self.flushCheckpoint()
+        logger.info('Waiting for event. Last event time: {0}'.format(stream.lastEventTime))
+        try:
+          # Shard leases must be rebalanced on time, however idle the VSphere server is
+          stream.wait(self.scheduler.interval if self.shards is None else min(self.scheduler.interval, self.shards.renewInterval))
+        except Exception as e:
+          FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
+          logger.error('Error occured while waiting for events: {0}'.format(e))
+          self.stopped.wait(SLEEP_TIME)
+        continue
+
+      if coalesceWindow > 0 and not retrying:
+        # Let the burst settle, then drain everything it produced so that each VM gets processed once
+        time.sleep(coalesceWindow)
+        while True:
+          moreEvents = self.readEvents(stream)
+          if not moreEvents:
+            break
+          events.extend(moreEvents)
+
+      if not self.processEvents(si, events):
+        retryEvents = events
+        self.stopped.wait(SLEEP_TIME)
+        continue
+      self.commitEvents(events)
+      if self.scheduler.overloaded:
+        # Pending events wait as well: vCenter needs some rest
+        self.stopped.wait(self.scheduler.interval)
+    self.workers.join()
+    if self.shards is not None:
+      # Hand the shards over right away instead of letting their leases expire
+      self.releaseShards(self.shards.ownedShards())
+      self.shards.leave()
+    self.flushCheckpoint(force=True)
+    return 0
+
+  def readEvents(self, stream):
+    # Returns None when the read failed
+    pageSize = self.scheduler.pageSize
+    startTime = time.perf_counter()
+    try:
+      events = stream.readNextPage(pageSize)
+    except Exception as e:
+      FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
+      logger.error('Error occured while reading events: {0}'.format(e))
+      return None
+    finally:
+      self.scheduler.observeLatency(time.perf_counter() - startTime)
+    self.scheduler.observePage(len(events), pageSize)
+    interval, idleCount, pageSizeMetric, overloaded = self.scheduleMetrics
+    interval.set(self.scheduler.interval)
+    idleCount.set(self.scheduler.idlePolls)
+    pageSizeMetric.set(self.scheduler.pageSize)
+    overloaded.set(1 if self.scheduler.overloaded else 0)
+    return events
+
+  def commitEvents(self, events):
+    lastEvent = max(events, key=lambda event: event.key)
+    self.eventLag.set((datetime.now(timezone('UTC')) - lastEvent.createdTime).total_seconds())
+    if self.catchingUp:
+      CATCHUP_EVENT_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address']).inc(len(events))
+    if self.checkpoint is None:
+      return
+    self.checkpoint.update(lastEvent.key, lastEvent.createdTime)
+    self.flushCheckpoint()
 
+  def flushCheckpoint(self, force=False):
+    checkpointDue = self.checkpoint is not None and (force or self.checkpoint.due())
+    if not (checkpointDue or force or self.vmIndex.due()):
+      return
+    if checkpointDue:
+      # Only checkpoint events whose VMs have been fully registered, and indexed
+      self.workers.join()
+    try:
+      self.vmIndex.flush()
+      self.vmIndexSize.set(len(self.vmIndex))
+      if checkpointDue:
+        self.checkpoint.flush()
+    except OSError as e:
+      FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
+      logger.error('Error occured while writing event checkpoint: {0}'.format(e))
+
+  def coalesceEvents(self, events):
+    # Only the latest event of each VM matters: its properties are read once, after the whole page
+    latestEvents = collections.OrderedDict()
+    # Rendering a whole event is expensive: only do it when it gets logged
+    debug = logger.isEnabledFor(logging.DEBUG)
+    for idx, event in enumerate(events):
+      if debug:
+        logger.debug('Event #%s at %s: %s', idx, event.createdTime, event.fullFormattedMessage)
+        logger.debug('Event data: %s', event)
+
+      eventCount = self.eventCounts.get(event.__class__.__name__)
+      if eventCount is None:
+        eventCount = self.eventCounts[event.__class__.__name__] = VMWARE_EVENT_COUNT.labels(event=event.__class__.__name__, **self.labels)
+      eventCount.inc()
+
+      if isinstance(event, tuple(VMWARE_MONITORED_CUSTOMFIELD_EVENTS)):
+        self.customFields.invalidate()
+        continue
+
+      if event.vm is None:
+        self.filterEvent(None)
+        continue
+
+      moId = event.vm.vm._moId
+      if moId in latestEvents:
+        self.coalescedEvents.inc()
+        del latestEvents[moId]
+      latestEvents[moId] = event
+    return list(latestEvents.values())
+
+  def processEvents(self, si, events, vms=None):
+    # Returns False when the page could not be processed: it must then be retried rather than checkpointed
+    logger.debug('Received %s event(s)', len(events))
+    readTime = time.time()
+    pageEvents = events
+    events = []
+    traces = {}
+    for event in self.coalesceEvents(pageEvents):
+      # Other replicas take care of the VMs of the shards this one doesn't own
+      if not self.isOwned(event.vm.vm._moId):
+        self.filterResults['other_shard'].inc()
+        continue
+      trace = self.tracer.trace(event)
+      if trace is not None:
+        trace.stage('coalesce')
+      if self.acceptEvent(event):
+        events.append(event)
+        if trace is not None:
+          traces[event.key] = trace
+      elif trace is not None:
+        trace.set('verdict', 'bad_name')
+        trace.emit()
+    logger.debug('%s event(s) left after coalescing', len(events))
+    if vms is None:
+      try:
+        vms = self.prefetchVms(si, events)
+      except Exception as e:
+        FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
+        logger.error('Error occured while retrieving VM properties: {0}'.format(e))
+        return False
+    # Only the events left after coalescing wait for a worker
+    self.eventBacklog.inc(len(events))
+    for trace in traces.values():
+      trace.stage('prefetch')
+    if self.capture is not None:
+      try:
+        self.capture.writePage(readTime, pageEvents, vms, self.customFields.get(), self.customFields.keys())
+      except Exception as e:
+        FAILURE_COUNT.labels(vc=self.cfg['vc_address'], dhcp=self.cfg['dhcp_address'], exception=e).inc()
+        logger.error('Error occured while capturing events: {0}'.format(e))
+    for event in events:
+      self.workers.submit(event.vm.vm._moId, self.processVm, event, vms.get(event.vm.vm._moId), traces.get(event.key))
+    return True
+
+  def replay(self, path, speed=1):
+    # Feed a capture through the filter and registration pipeline, speed times faster than it was recorded (0: as fast as possible)
+    startExporter(self.cfg)
+    self.customFields = StaticCustomFieldCache()
+    # Never touch the index nor the shards of the live service
+    self.vmIndex = VmIndex()
+    self.shards = None
+    self.catchingUp = False
+    self.checkpoint = None
+    startTime = time.time()
+    firstPageTime = None
+    eventCount = 0
+    vmCount = 0
+    for page in readCapture(path):
+      if firstPageTime is None:
+        firstPageTime = page.time
+      if speed > 0:
+        delay = startTime + (page.time - firstPageTime) / speed - time.time()
+        if delay > 0:
+          time.sleep(delay)
+      self.customFields.dhcpOptionNames = page.customFields
+      self.customFields.attributeKeys = page.attributeKeys
+      self.processEvents(None, page.events, page.vms)
+      eventCount += len(page.events)
+      vmCount += len(page.vms)
+    self.workers.join()
+    elapsed = time.time() - startTime
+    logger.info('Replayed {0} event(s) and {1} VM snapshot(s) in {2:.1f}s ({3:.1f} events/s)'.format(eventCount, vmCount, elapsed, eventCount / elapsed if elapsed > 0 else 0))
+    return 0
+
+  def processVm(self, event, vm, trace=None):
+    if trace is not None:
+      trace.stage('queue')
+    try:
+      if not self.isOwned(event.vm.vm._moId):
+        # The shard lease was lost while the event was waiting for a worker
+        self.filterResults['other_shard'].inc()
+        if trace is not None:
+          trace.set('verdict', 'other_shard')
+      elif isinstance(event, tuple(VMWARE_MONITORED_ADD_EVENTS)):
+        if self.filterEvent(vm, trace):
+          self.registerVm(vm, event.createdTime)
+      elif isinstance(event, tuple(VMWARE_MONITORED_UPDATE_EVENTS)):
+        if self.filterEvent(vm, trace):
+          self.registerVm(vm, event.createdTime)
+      elif isinstance(event, tuple(VMWARE_MONITORED_REMOVE_EVENTS)):
+        # Virtual Machine object properties are lost when this event pops up: use the indexed mac addresses
+        macAddresses = self.removeVm(event.vm.vm._moId)
+        if trace is not None:
+          trace.set('verdict', 'removed')
+          trace.set('macs', macAddresses)
+    finally:
+      self.eventBacklog.dec()
+      if trace is not None:
+        if vm is not None and trace.record.get('verdict') == 'accepted':
+          trace.set('macs', vm.macAddresses)
+        trace.stage('dhcpd')
+        trace.emit()
+
+
+class Supervisor():
+  def __init__(self, cfg):
+    self.cfg = cfg
+    self.pools = {}
+    self.stores = {}
+    self.sources = []
+    for source in cfg['sources']:
+      sourceCfg = dict(cfg)
+      del sourceCfg['sources']
+      sourceCfg.update(dict((key, value) for key, value in source.items() if key != 'targets'))
+      for key in ['capture_file', 'checkpoint_file', 'vm_index_file']:
+        if key not in source and sourceCfg.get(key):
+          sourceCfg[key] = '{0}.{1}'.format(sourceCfg[key], sourceCfg['vc_address'])
+      targetCfgs = []
+      for target in source.get('targets') or [{}]:
+        targetCfg = dict(sourceCfg)
+        targetCfg.update(target)
+        targetCfgs.append(targetCfg)
+      # vCenter side metrics of a source are labeled with all the DHCP servers it feeds
+      sourceCfg['dhcp_address'] = ','.join(targetCfg['dhcp_address'] for targetCfg in targetCfgs)
+      self.sources.append((sourceCfg, targetCfgs))
+
+    # OMAPI sessions and desired state are per DHCP server, whatever the vCenters feeding it
+    vcAddresses = collections.defaultdict(set)
+    for sourceCfg, targetCfgs in self.sources:
+      for targetCfg in targetCfgs:
+        vcAddresses[self.dhcpKey(targetCfg)].add(sourceCfg['vc_address'])
+    for sourceCfg, targetCfgs in self.sources:
+      for targetCfg in targetCfgs:
+        key = self.dhcpKey(targetCfg)
+        if key not in self.pools:
+          poolCfg = dict(targetCfg)
+          poolCfg['vc_address'] = ','.join(sorted(vcAddresses[key]))
+          self.pools[key] = OmapiPool(poolCfg, int(targetCfg.get('dhcp_pool_size', 1)))
+          self.stores[key] = DesiredStateStore()
+
+  @staticmethod
+  def dhcpKey(targetCfg):
+    return (targetCfg['dhcp_address'], int(targetCfg['dhcp_port']))
+
+  def run(self, sourceCfg, targetCfgs):
+    dhcpTargets = [DhcpTarget(targetCfg, self.pools[self.dhcpKey(targetCfg)], self.stores[self.dhcpKey(targetCfg)]) for targetCfg in targetCfgs]
+    # Restarted event loops keep the workers of the source: its VMs are still registered in order
+    workers = ShardedWorkerPool(sourceCfg, int(sourceCfg.get('workers', 0)))
+    atexit.register(workers.close)
+    while True:
+      try:
+        Vmware2dhcp(sourceCfg, dhcpTargets, workers).start()
+      except (Exception, SystemExit) as e:
+        FAILURE_COUNT.labels(vc=sourceCfg['vc_address'], dhcp=sourceCfg['dhcp_address'], exception=e).inc()
+        logger.error('Event loop of VSphere server {0} stopped: {1}. Restarting in {2}s'.format(sourceCfg['vc_address'], e, SLEEP_TIME))
       time.sleep(SLEEP_TIME)
+
+  def start(self):
+    startExporter(self.cfg)
+    threads = []
+    for sourceCfg, targetCfgs in self.sources:
+      logger.info('Starting event loop for VSphere server {0} feeding DHCP server(s) {1}'.format(sourceCfg['vc_address'], sourceCfg['dhcp_address']))
+      thread = threading.Thread(target=self.run, args=(sourceCfg, targetCfgs), name=sourceCfg['vc_address'], daemon=True)
+      thread.start()
+      threads.append(thread)
+    for pool in self.pools.values():
+      atexit.register(pool.close)
+    for thread in threads:
+      thread.join()
     return 0